@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""
+Micro-benchmarks for the spectrogram pipeline. Each subcommand times one
+step on the given files and prints the time per file, best of --repeat runs.
+
+  decode: reading audio files in process (extract_melspect.read_wave,
+          resampling with a polyphase filter where needed) versus
+          decoding them with avconv/ffmpeg (extract_melspect.read_ffmpeg)
+  kernels: the magnitude scaling kernels of extract_melspect (logarithmize,
+          Phonify, sonify) on random spectrograms, against their previous
+          implementations: checks that results are identical and reports
+          the time per frame and the peak memory added by each call
+  features: mel spectrograms computed on the fly from audio files (as by
+          load_data.py type=melspect), one by one and in batches
+          (extract_melspect.batch_melspect), versus reading them from
+          precomputed .h5 files (as written by prepare_spectrograms.sh);
+          reports items per second and the difference of the results
+"""
+
+import numpy as np
+import os
+import sys
+from timeit import default_timer
+
+import extract_melspect
+
+import argparse
+parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+parser.add_argument("--repeat", type=int, default=3, help="number of runs per file, the best one counts (default=%(default)s)")
+subparsers = parser.add_subparsers(dest='command')
+
+decode_parser = subparsers.add_parser('decode', help='time in-process audio decoding against avconv/ffmpeg')
+decode_parser.add_argument("files", nargs='+', type=str, help="audio files (.wav)")
+decode_parser.add_argument("-r", "--sample-rate", type=int, default=22050, help="target sample rate in Hz (default=%(default)s)")
+decode_parser.add_argument("--no-downmix", action='store_true', help="keep the channels separate")
+
+kernels_parser = subparsers.add_parser('kernels', help='time the magnitude scaling kernels and check them against their previous implementations')
+kernels_parser.add_argument("--frames", type=int, default=20000, help="spectrogram frames (default=%(default)s)")
+kernels_parser.add_argument("--bands", type=int, default=80, help="frequency bands (default=%(default)s)")
+kernels_parser.add_argument("--seed", type=int, default=0, help="random seed (default=%(default)s)")
+
+features_parser = subparsers.add_parser('features', help='time on-the-fly mel spectrograms against reading precomputed .h5 files')
+features_parser.add_argument("files", nargs='+', type=str, help="audio files (<dataset>/<clip>.wav)")
+features_parser.add_argument("--spect-dir", type=str, help="precomputed spectrograms (<dir>/<dataset>/<clip>.wav.h5), by default computed into a temporary directory first")
+features_parser.add_argument("-r", "--sample-rate", type=int, default=22050, help="sample rate in Hz (default=%(default)s)")
+features_parser.add_argument("-f", "--frame-rate", type=float, default=70., help="frames per second (default=%(default)s)")
+features_parser.add_argument("-l", "--fft-length", type=int, default=1024, help="FFT length (default=%(default)s)")
+features_parser.add_argument("-m", "--min-freq", type=float, default=50., help="minimum frequency of the mel bank (default=%(default)s)")
+features_parser.add_argument("-M", "--max-freq", type=float, default=11000., help="maximum frequency of the mel bank (default=%(default)s)")
+features_parser.add_argument("-b", "--bands", type=int, default=80, help="number of mel bands (default=%(default)s)")
+features_parser.add_argument("--batch", type=int, default=16, help="items computed together (default=%(default)s)")
+
+
+def best_time(func, repeat):
+    """Returns the result of func() and its shortest run time in seconds"""
+    best = None
+    for _ in xrange(max(1, repeat)):
+        start = default_timer()
+        result = func()
+        t = default_timer()-start
+        best = t if best is None else min(best, t)
+    return result, best
+
+
+def report(name, times):
+    """Prints the mean time per file"""
+    if times:
+        print "%s: %.2f ms/file (%i files)"%(name, 1000.*np.mean(times), len(times))
+    else:
+        print "%s: not available"%name
+
+
+def bench_decode(args):
+    downmix = not args.no_downmix
+    native = []
+    decoder = []
+    max_diff = 0.
+    for fn in args.files:
+        try:
+            a, t = best_time(lambda: extract_melspect.read_wave(fn, args.sample_rate, downmix, resample='poly'), args.repeat)
+            native.append(t)
+        except ValueError as exc:
+            print >>sys.stderr, "%s: not read natively (%s)"%(fn, exc)
+            a = None
+        try:
+            b, t = best_time(lambda: extract_melspect.with_decoder(extract_melspect.read_ffmpeg, fn, args.sample_rate, downmix), args.repeat)
+            decoder.append(t)
+        except Exception as exc:
+            print >>sys.stderr, "%s: not decoded by %s (%s)"%(fn, '/'.join(extract_melspect._decoders), exc)
+            b = None
+        if a is not None and b is not None and a.shape == b.shape and a.size:
+            max_diff = max(max_diff, float(np.abs(a-b).max()))
+    report("in process", native)
+    report("decoder", decoder)
+    if native and decoder and len(native) == len(decoder):
+        print "speedup: %.1fx, max abs difference: %.3g"%(np.sum(decoder)/np.sum(native), max_diff)
+
+
+# previous implementations of the magnitude scaling kernels, for checking
+# that the in-place versions give identical results
+
+def reference_phonify(phonify, frames, out=None):
+    frames = np.asarray(frames)
+    spec = phonify.todB(frames)
+    if out is None:
+        out = np.empty_like(spec)
+    out[:] = spec
+    out += phonify.corr
+    if phonify.clip:
+        np.maximum(out, 0., out=out)
+    return out
+
+
+def reference_sonify(phons, out=None):
+    phons = np.asarray(phons)
+    if out is None:
+        out = np.empty_like(phons)
+    out[:] = phons
+    out -= 40.
+    out *= 0.1
+    np.power(2., out, out=out)
+    idx = out < 1.
+    small = phons[idx]
+    small *= (1./40.)
+    np.power(small, 2.642, out=small)
+    out[idx] = small
+    return out
+
+
+def reference_logarithmize(spect, stretch=1.0, shift=0.0):
+    if np.iscomplexobj(spect):
+        phases = np.angle(spect)
+        spect = np.abs(spect)
+    else:
+        phases = None
+    if stretch != 1:
+        spect *= stretch
+    if shift == 0:
+        np.maximum(spect, 2.220446049250313e-16, spect)
+        np.log(spect, spect)
+    elif shift == 1:
+        np.log1p(spect, spect)
+    else:
+        spect += shift
+        np.log(spect, spect)
+    if phases is not None:
+        spect = spect * np.exp(1.j*phases)
+    return spect
+
+
+def memory_status(key):
+    """Returns a memory figure of this process from /proc/self/status in bytes"""
+    with open('/proc/self/status') as f:
+        for ln in f:
+            if ln.startswith(key+':'):
+                return int(ln.split()[1])*1024
+
+
+def run_kernel(kernel, make_input, repeat):
+    """
+    Runs kernel on fresh inputs. Returns the last result, the shortest run
+    time and the growth of the peak resident memory during a call in bytes
+    (None if it cannot be measured, which needs Linux 4.0 or later).
+    """
+    best = peak = None
+    for _ in xrange(max(1, repeat)):
+        x = make_input()
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5') # resets the peak resident memory
+            before = memory_status('VmRSS')
+        except (IOError, TypeError):
+            before = None
+        start = default_timer()
+        result = kernel(x)
+        t = default_timer()-start
+        if before is not None:
+            peak = max(peak, memory_status('VmHWM')-before)
+        best = t if best is None else min(best, t)
+    return result, best, peak
+
+
+def identical(a, b):
+    """Returns whether two arrays have the same type, shape and values (NaNs included)"""
+    a = np.asarray(a)
+    b = np.asarray(b)
+    return a.dtype == b.dtype and a.shape == b.shape and bool(np.all((a == b) | (np.isnan(a) & np.isnan(b))))
+
+
+def bench_kernels(args):
+    from extract_melspect import Phonify, sonify, logarithmize
+    try:
+        # serve large arrays by mmap, so freed ones do not stay resident
+        # and hide the memory of later temporaries (M_MMAP_THRESHOLD = -3)
+        import ctypes
+        ctypes.CDLL('libc.so.6').mallopt(-3, 1<<16)
+    except (OSError, AttributeError):
+        pass
+    rng = np.random.RandomState(args.seed)
+    freqs = np.linspace(50., 11000., args.bands)
+    phonify = Phonify(freqs)
+    mags = {}
+    for dtype in (np.float64, np.float32):
+        # magnitudes including zeros, as for silence
+        m = np.abs(rng.standard_cauchy((args.frames, args.bands))).astype(dtype)
+        m[rng.rand(*m.shape) < 0.01] = 0
+        mags[np.dtype(dtype).name] = m
+    phons = dict((k, reference_phonify(phonify, m)) for k, m in mags.iteritems())
+    cmags = dict((k.replace('float', 'complex').replace('64', '128').replace('32', '64'),
+                  (m*np.exp(2.j*np.pi*rng.rand(*m.shape))).astype(np.result_type(m, np.complex64)))
+                 for k, m in mags.iteritems())
+    cases = []
+    for k, m in sorted(mags.iteritems()):
+        cases.append(('log %s'%k, m, lambda x: reference_logarithmize(x), lambda x: logarithmize(x)))
+        cases.append(('log1p %s'%k, m, lambda x: reference_logarithmize(x, 2., 1.), lambda x: logarithmize(x, 2., 1.)))
+        cases.append(('phon %s in-place'%k, m, lambda x: reference_phonify(phonify, x, out=x), lambda x: phonify(x, out=x)))
+        cases.append(('phon %s'%k, m, lambda x: reference_phonify(phonify, x), lambda x: phonify(x)))
+        cases.append(('phon %s to float32'%k, m, lambda x: reference_phonify(phonify, x, out=np.empty(x.shape, np.float32)),
+                      lambda x: phonify(x, out=np.empty(x.shape, np.float32))))
+    for k, p in sorted(phons.iteritems()):
+        cases.append(('sone %s in-place'%k, p, lambda x: reference_sonify(x, out=x), lambda x: sonify(x, out=x)))
+        cases.append(('sone %s'%k, p, lambda x: reference_sonify(x), lambda x: sonify(x)))
+    for k, z in sorted(cmags.iteritems()):
+        cases.append(('log %s'%k, z, lambda x: reference_logarithmize(x), lambda x: logarithmize(x)))
+        cases.append(('log %s in-place'%k, z, lambda x: reference_logarithmize(x), lambda x: logarithmize(x, out=x)))
+    failed = 0
+    print "%-28s %12s %12s %14s %14s %s"%("kernel", "previous", "now", "previous peak", "now peak", "result")
+    for name, data, previous, now in cases:
+        ref, tref, mref = run_kernel(previous, data.copy, args.repeat)
+        res, tnow, mnow = run_kernel(now, data.copy, args.repeat)
+        same = identical(ref, res)
+        failed += not same
+        mb = lambda m: "n/a" if m is None else "%.1f MB"%(m/2.**20)
+        print "%-28s %9.3f us %9.3f us %14s %14s %s"%(name, 1.e6*tref/len(data), 1.e6*tnow/len(data), mb(mref), mb(mnow), "identical" if same else "DIFFERENT")
+    if failed:
+        print >>sys.stderr, "%i kernels differ from their previous implementation"%failed
+        sys.exit(1)
+
+
+def bench_features(args):
+    import h5py
+    import shutil
+    import tempfile
+    import spectstore
+    # same parameters as prepare_spectrograms.sh
+    options, _ = extract_melspect.opts_parser().parse_args(['--channels=mix-after', '-r', str(args.sample_rate),
+        '-f', str(args.frame_rate), '-l', str(args.fft_length), '-t', 'mel', '-m', str(args.min_freq), '-M', str(args.max_freq),
+        '-b', str(args.bands), '-s', 'log', '--featname', 'features', '--include-times', '--times-mode=borders'])
+    spect_args = extract_melspect.extract_options(options)
+    spect_dir = args.spect_dir or tempfile.mkdtemp()
+    spect_fn = lambda fn: os.path.join(spect_dir, os.path.basename(os.path.dirname(os.path.abspath(fn))), os.path.basename(fn)+'.h5')
+    try:
+        if not args.spect_dir:
+            for fn in args.files:
+                if not os.path.isdir(os.path.dirname(spect_fn(fn))):
+                    os.makedirs(os.path.dirname(spect_fn(fn)))
+                extract_melspect.process_file(fn, spect_fn(fn), options)
+
+        def precomputed():
+            result = []
+            for fn in args.files:
+                with h5py.File(spect_fn(fn), 'r') as f5:
+                    data = dict((k, f5[k][()]) for k in ('features', 'features_scale', 'features_offset') if k in f5)
+                result.append(spectstore.dequantize(data, 'features'))
+            return result
+
+        def single():
+            return [extract_melspect.extract_melspect(fn, args.sample_rate, **dict(spect_args))[0] for fn in args.files]
+
+        def batched():
+            result = []
+            for pos in xrange(0, len(args.files), max(1, args.batch)):
+                spects = extract_melspect.batch_melspect(args.files[pos:pos+max(1, args.batch)], args.sample_rate, **dict(spect_args))
+                result += [s[0] for s in spects]
+            return result
+
+        # the precomputed files are read once before, so they are in the page cache
+        ref, t = best_time(precomputed, args.repeat)
+        print "precomputed .h5: %.1f items/s (%i items)"%(len(ref)/t, len(ref))
+        for name, func in (("on the fly", single), ("on the fly, batches of %i"%args.batch, batched)):
+            res, t = best_time(func, args.repeat)
+            if any(a.shape != b.shape for a, b in zip(ref, res)):
+                raise ValueError("%s: shapes differ from the precomputed spectrograms"%name)
+            max_diff = max([float(np.abs(a-b).max()) for a, b in zip(ref, res) if a.size] or [0.])
+            print "%s: %.1f items/s, max abs difference: %.3g"%(name, len(res)/t, max_diff)
+    finally:
+        if not args.spect_dir:
+            shutil.rmtree(spect_dir)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    dict(decode=bench_decode, kernels=bench_kernels, features=bench_features)[args.command](args)
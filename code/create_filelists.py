@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8
 
+import numpy as np
 import sys
 
 import argparse
@@ -11,24 +12,91 @@ parser.add_argument('filelists', type=str, nargs='+', help='filelists')
 parser.add_argument('--out', default="./%(fold)s_%(num)i", help='output file name (template parameter: fold, num)')
 parser.add_argument('--log', action='store_true', help='Log to console')
 parser.add_argument('--mode', default="train", help='"train" or "test"')
+parser.add_argument('--store', type=str, help='spectrogram store file name, used as index of spectrogram frames per item (template parameter: dataset)')
+parser.add_argument('--balance-labels', action='store_true', help='subsample train lists to the same number of frames per label (requires --store)')
+parser.add_argument('--cap-frames', type=str, help='cap train lists at a number of frames, or "min" for the smallest train list of all folds (requires --store)')
+parser.add_argument('--seed', type=int, default=0, help='random seed for subsampling train lists (default: %(default)s)')
+parser.add_argument('--epochs', type=int, default=1, help='number of training epochs for the compute report (default: %(default)s)')
+parser.add_argument('--report', type=str, help='write per-fold items, frames and compute (frames x epochs) as CSV to this file (requires --store)')
 args = parser.parse_args()
 
 fileids = []
 datasetlists = {} # a dict holding 'datasetid'=>[filelist]
+itemlabels = {}
 for filelist in args.filelists:
     with open("%s/%s.csv"%(args.path, filelist), 'r') as f:
         for ln in f:
             if not ln.startswith("itemid"):
-                item, datasetid = ln.strip().split(",")[0:2]
+                cols = ln.strip().split(",")
+                item, datasetid = cols[0:2]
                 if datasetid not in datasetlists:
                     datasetlists[datasetid] = []
                 datasetlists[datasetid].append("%s/%s.wav"%(filelist, item))
+                itemlabels["%s/%s.wav"%(filelist, item)] = cols[2] if len(cols) > 2 else None
+
+# spectrogram frames per item, from the indices of the spectrogram stores
+itemframes = {}
+framerate = None
+if args.store:
+    import spectstore
+    for filelist in args.filelists:
+        with spectstore.SpectStore(args.store%dict(dataset=filelist)) as store:
+            framerate = store.framerate
+            for k, (_, length) in store.index.iteritems():
+                itemframes["%s/%s"%(filelist, k)] = length
+    missing = [i for i in itemlabels if i not in itemframes]
+    if missing:
+        raise ValueError("No spectrogram frames found for %i items, e.g. %s"%(len(missing), missing[0]))
+elif args.balance_labels or args.cap_frames or args.report:
+    parser.error('--balance-labels, --cap-frames and --report require --store')
+
+
+def class_targets(items):
+    """
+    Splits items by label and returns the lists along with the number of
+    frames to select from each.
+    """
+    labels = sorted(set(itemlabels[i] for i in items))
+    byclass = [[i for i in items if itemlabels[i] == l] for l in labels]
+    totals = [sum(itemframes[i] for i in c) for c in byclass]
+    if args.balance_labels:
+        return byclass, [min(totals)]*len(totals)
+    return byclass, totals
+
+
+def limit_train(items, cap, rng):
+    """
+    Returns a random subset of the train items, in their original order,
+    balanced by label and/or capped at a total number of frames
+    (per label in proportion to the label's frames).
+    """
+    byclass, targets = class_targets(items)
+    if cap and sum(targets) > cap:
+        targets = [t*float(cap)/sum(targets) for t in targets]
+    selected = set()
+    for classitems, target in zip(byclass, targets):
+        frames = np.asarray([itemframes[i] for i in classitems])
+        perm = rng.permutation(len(classitems))
+        keep = perm[:np.searchsorted(np.cumsum(frames[perm]), target, side='right')]
+        selected.update(classitems[i] for i in keep)
+    return [i for i in items if i in selected]
 
 # create folds - same as number of datasetids (during train/val), since each one is treated as its own validation set
 if args.mode=='train':
     nfolds = len(datasetlists)
 else:
     nfolds = 1   # for "testing" we currently pool all together
+
+cap = None
+if args.cap_frames == 'min':
+    # the train list of fold n consists of all datasets but the n-th
+    allitems = [i for _, itemlist in datasetlists.items() for i in itemlist]
+    cap = min(sum(class_targets([i for i in allitems if i not in valitems])[1])
+              for valitems in (set(itemlist) for _, itemlist in datasetlists.items()))
+elif args.cap_frames:
+    cap = int(args.cap_frames)
+
+report = []
 for n in range(nfolds):
 
     if args.mode=='train':
@@ -39,6 +107,8 @@ for n in range(nfolds):
                 items_val.extend(itemlist)
             else:
                 items_trn.extend(itemlist)
+        if args.balance_labels or cap:
+            items_trn = limit_train(items_trn, cap, np.random.RandomState(args.seed+n))
         foldcollection = [("train", items_trn), ("val", items_val)]
     elif args.mode=='test':
         items_tst = []
@@ -56,3 +126,17 @@ for n in range(nfolds):
         if args.log:
             print >>sys.stderr, "Wrote %s_%i with %i files"%(name, n+1, len(folditems))
 
+    if itemframes:
+        for name, folditems in foldcollection:
+            # training passes over the train list for each epoch, prediction once over the others
+            frames = sum(itemframes[i] for i in folditems)
+            epochs = args.epochs if name == 'train' else 1
+            report.append((name, n+1, len(folditems), frames, frames/framerate/3600., frames*epochs))
+            print >>sys.stderr, "%s_%i: %i files, %i frames (%.2f h), compute %i frames x %i epochs = %i"%(name, n+1, len(folditems), frames, frames/framerate/3600., frames, epochs, frames*epochs)
+
+if args.report:
+    with open(args.report, 'w') as f:
+        print >>f, "fold,num,files,frames,hours,compute"
+        for r in report:
+            print >>f, "%s,%i,%i,%i,%.4f,%i"%r
+
@@ -1,11 +1,11 @@
 #!/usr/bin/env python
 
-from sklearn.metrics import roc_auc_score
-from scipy.stats import hmean
+import numpy as np
 import argparse
-import os
 import sys
 
+import predtable
+
 parser = argparse.ArgumentParser()
 parser.add_argument("pred", type=str, help="prediction file")
 parser.add_argument("gt", nargs='+', type=str, help="ground truth file(s)")
@@ -16,49 +16,59 @@ parser.add_argument("--gt-suffix", type=str, default='', help="suffix for items
 parser.add_argument("--splits", type=str, default='', help="split file lists for individual scores (comma separated)")
 parser.add_argument("--split-header", action='store_true', help="header line present in split file(s)")
 parser.add_argument("--split-suffix", type=str, default='', help="suffix for items in split file(s)")
+parser.add_argument("--bootstrap", type=int, default=0, help="number of bootstrap resamples for confidence intervals (default=%(default)s)")
+parser.add_argument("--seed", type=int, default=0, help="random seed for bootstrap resampling (default=%(default)s)")
+parser.add_argument("--ci", type=float, default=95., help="confidence interval width in percent (default=%(default)s)")
 args = parser.parse_args()
 
-pred_probs = {}
-with open(args.pred, 'r') as f:
-    if args.pred_header:
-        f.next()
-    for ln in f:
-        k,v = ln.strip().split(',')
-        pred_probs[k+args.pred_suffix] = float(v)
 
-gt_labels = {}
-for gtfn in args.gt:
-    subpath = os.path.splitext(os.path.split(gtfn)[-1])[0]
-    with open(gtfn, 'r') as f:
-        if args.gt_header:
-            f.next()
-        for ln in f:
-            k,_,v = ln.strip().split(',')
-            gt_labels[os.path.join(subpath,k)+args.gt_suffix] = float(v)
+def hmean(a, axis=0):
+    """Harmonic mean of positive values"""
+    a = np.asarray(a, dtype=np.float64)
+    return a.shape[axis]/np.sum(1./a, axis=axis)
+
 
-gt_items = set(pred_probs.iterkeys())
-pred_items = set(gt_labels.iterkeys())
+pred, _ = predtable.read_predictions(args.pred, header=args.pred_header, suffix=args.pred_suffix)
+gt = predtable.read_filelists(args.gt, header=args.gt_header, suffix=args.gt_suffix, subpath=True)
 
-both = gt_items&pred_items
-missing = gt_items^pred_items
+# items with prediction and ground truth, sorted by id
+both, missing = pred.join(gt)
 if len(missing):
-    print >>sys.stderr, "Items %s missing in either set"%missing
+    print >>sys.stderr, "Items %s missing in either set"%set(missing)
+
+
+def interval(aucs):
+    """Returns the bootstrap percentile interval of the given AUCs"""
+    q = (100.-args.ci)/2.
+    return tuple(np.nanpercentile(aucs, [q, 100.-q]))
+
+rng = np.random.RandomState(args.seed)
+cilines = [] # bootstrap results, printed after the scores
 
 if args.splits:
     splaucs = []
+    splboots = []
     for splfn in args.splits.split(','):
-        with open(splfn, 'r') as f:
-            if args.split_header:
-                f.next()
-            split = set(ln.strip().split(',', 1)[0]+args.split_suffix for ln in f)
-        both = gt_items&split
-        splauc = roc_auc_score([gt_labels[k] for k in both], [pred_probs[k] for k in both])
-        splaucs.append(splauc)
+        split = both.take(both.mask(predtable.read_ids(splfn, header=args.split_header, suffix=args.split_suffix)))
+        auc = predtable.AUC(split.label, split.pred)
+        splaucs.append(auc())
+        if args.bootstrap:
+            splboots.append(auc.bootstrap(args.bootstrap, rng))
 
     auc_hmean = hmean(splaucs)
     print("%.6f" % (auc_hmean)),
     print "("+",".join("%.6f"%r for r in splaucs)+")",
+    if args.bootstrap:
+        # harmonic mean over splits per resample
+        cilines.append("hmean %.1f%% CI: [%.6f,%.6f]"%((args.ci,)+interval(hmean(splboots, axis=0))))
+        for splfn, boots in zip(args.splits.split(','), splboots):
+            cilines.append("%s %.1f%% CI: [%.6f,%.6f]"%((splfn, args.ci)+interval(boots)))
 else:
-    auc_total = roc_auc_score([gt_labels[k] for k in both], [pred_probs[k] for k in both])
+    auc = predtable.AUC(both.label, both.pred)
+    auc_total = auc()
     print "%.6f"%auc_total,
+    if args.bootstrap:
+        cilines.append("%.1f%% CI: [%.6f,%.6f]"%((args.ci,)+interval(auc.bootstrap(args.bootstrap, rng))))
 print
+for ln in cilines:
+    print ln
@@ -10,11 +10,15 @@ Author: Jan Schlüter and Thomas Grill
 """
 
 from optparse import OptionParser
-from itertools import izip, chain
+from itertools import izip, imap
 import numpy as np
-import wave
+from numpy.lib.stride_tricks import as_strided
+import os
+import sys
+from collections import OrderedDict
 
-from filterbank import FilterBank
+from filterbank import FilterBank, get_filterbank
+from spectstore import SpectStore, STORE_SUFFIX, QUANTIZED_DTYPES, quantize, quantize_data
 
 def opts_parser():
 	usage =\
@@ -22,10 +26,16 @@ def opts_parser():
 mel or log spectrograms.
 
 Usage: %prog [OPTIONS] INFILE OUTFILE
-  INFILE: .wav file (16 bit, mono), .raw file (32 bit floats, mono, no header)
-      or any file supported by ffmpeg
+  INFILE: .wav file (8/16/24/32 bit integer or 32/64 bit float samples),
+      .raw file (32 bit floats, mono, no header) or any file supported by ffmpeg
   OUTFILE: .npz/.h5 output file, features will be called \'melspect<framelen>\',
       or .npy output file, valid only if a single framelength was requested
+
+Batch usage: %prog [OPTIONS] --manifest FILE
+         or: %prog [OPTIONS] --input-glob PATTERN --output-dir DIR
+  Processes many files in a single run (and --jobs parallel processes),
+  skipping existing outputs. With --store, the spectrograms are collected
+  in one consolidated store per dataset instead of one file per input.
 """
 	parser = OptionParser(usage=usage)
 	parser.add_option('-r', '--sample-rate',
@@ -38,6 +48,13 @@ Usage: %prog [OPTIONS] INFILE OUTFILE
 			type='str', default='2048',
 			help='Comma-separated list of spectrogram frame lengths in samples '
 				'(default: %default)')
+	parser.add_option('--resample',
+			type='choice', choices=('ffmpeg', 'poly'), default='ffmpeg',
+			help='How to resample .wav files of another sample rate: with '
+				'ffmpeg/avconv, or in process with a polyphase filter (needs '
+				'scipy; not for --stream). ffmpeg is the default as its '
+				'resampling gave the best results (see readme.md) and keeps '
+				'existing features unchanged (default: %default)')
 	parser.add_option('--channels', metavar='TREATMENT',
 			type='choice', choices=('mix-before', 'mix-after', 'concat', 'split'), default='mix-before',
 			help='What to do with multi-channel (stereo) audio files: '
@@ -86,11 +103,41 @@ Usage: %prog [OPTIONS] INFILE OUTFILE
 			action='store_true', default=False,
 			help='If given, preserve the per-bin energy of the transformation '
 				'(always true for phon or sone magnitudes).')
+	parser.add_option('--block-size',
+			type='int', default=1024,
+			help='Number of frames transformed at once; limits the memory '
+				'needed for long recordings (default: %default)')
+	parser.add_option('--stream',
+			action='store_true', default=False,
+			help='If given, read the input and write the spectrograms block by '
+				'block (see --block-size), so memory does not grow with the '
+				'length of the recording. Only for .h5 output files, not with '
+				'--store.')
+	parser.add_option('--bank-cache', metavar='DIR',
+			type='str', default='',
+			help='If given, store computed filterbanks in this directory '
+				'and reuse them in later runs')
 	parser.add_option('--featname',
 			type='str', default='melspect%(len)s',
 			help='Template for the names of the feature matrices in the output '
 				'file. If present, the string %(len)s is replaced by the '
 				'spectrogram frame length in samples. (default: %default)')
+	parser.add_option('--dtype',
+			type='choice', choices=QUANTIZED_DTYPES, default='float32',
+			help='Storage type of the spectrograms: float32, float16, or uint8 '
+				'with a per-file scale and offset stored as <name>_scale and '
+				'<name>_offset (not for .npy output) (default: %default)')
+	parser.add_option('--compression',
+			type='choice', choices=('none', 'gzip', 'lzf'), default='none',
+			help='Compression of .h5 and store datasets (none, gzip or lzf), '
+				'or of .npz files (any but none) (default: %default)')
+	parser.add_option('--compression-level',
+			type='int', default=4,
+			help='Level of gzip compression, 0-9 (default: %default)')
+	parser.add_option('--chunk-frames',
+			type='int', default=0,
+			help='Number of frames per chunk of .h5 datasets; 0 for contiguous '
+				'uncompressed datasets and 1024 frames otherwise (default: %default)')
 	parser.add_option('--include-times',
 			action='store_true', default=False,
 			help='If given, the output file will contain a vector "times" of time '
@@ -102,32 +149,174 @@ Usage: %prog [OPTIONS] INFILE OUTFILE
 			help='Set mode for output time stamps, '
 				'with a choice of beginnings, centers, or borders. '
 				'(default: %default)')
+	parser.add_option('--manifest', metavar='FILE',
+			type='str', default='',
+			help='Batch mode: process all INFILE,OUTFILE pairs listed in '
+				'FILE, one pair per line')
+	parser.add_option('--input-glob', metavar='PATTERN',
+			type='str', default='',
+			help='Batch mode: process all files matching PATTERN (such as '
+				'"audio/*/*.wav"), writing to --output-dir')
+	parser.add_option('--output-dir', metavar='DIR',
+			type='str', default='',
+			help='Output directory for --input-glob; outputs are written to '
+				'DIR/<subdirectory>/<filename><suffix>')
+	parser.add_option('--output-suffix',
+			type='str', default='.h5',
+			help='Output file suffix for --input-glob (default: %default)')
+	parser.add_option('--store',
+			action='store_true', default=False,
+			help='Batch mode: collect the spectrograms in consolidated stores '
+				'(see spectstore.py), keyed by input file name. With '
+				'--input-glob, one store DIR/<subdirectory>%s is written '
+				'per subdirectory; with --manifest, OUTFILE names the store.'%STORE_SUFFIX)
+	parser.add_option('-j', '--jobs',
+			type='int', default=1,
+			help='Batch mode: number of parallel processes (default: %default)')
+	parser.add_option('--overwrite',
+			action='store_true', default=False,
+			help='Batch mode: recompute outputs that are up to date '
+				'(by default, only missing outputs and outputs computed with '
+				'other parameters or from a since modified input are computed)')
 	return parser
 
-def read_wave(infile, sample_rate, downmix=True):
-	f = wave.open(infile)
-	try:
-		if (f.getsampwidth() != 2) or (f.getframerate() != sample_rate):
-			raise ValueError("Unsupported wave file. Needs 16 bits, %d Hz." % sample_rate)
-		num_channels = f.getnchannels()
-		num_samples = f.getnframes()
-		samples = f.readframes(num_samples)
-	finally:
-		f.close()
-	samples = np.frombuffer(samples, dtype=np.int16)
-	samples = (samples / 2.**15).astype(np.float32)
+def wave_info(infile):
+	"""Parses the RIFF header of a .wav file. Returns a dict with the
+	sample 'format' ('int' or 'float'), 'channels', 'sample_rate', 'bits'
+	per sample, and the byte 'offset' and 'size' of the sample data.
+	Raises ValueError for anything but PCM or float samples."""
+	import struct
+	with open(infile, 'rb') as f:
+		riff = f.read(12)
+		if len(riff) < 12 or riff[:4] != 'RIFF' or riff[8:] != 'WAVE':
+			raise ValueError("Not a RIFF/WAVE file: %s" % infile)
+		info = None
+		while True:
+			header = f.read(8)
+			if len(header) < 8:
+				raise ValueError("No sample data in wave file %s" % infile)
+			chunk, size = struct.unpack('<4sI', header)
+			if chunk == 'fmt ':
+				fmt = f.read(size + (size & 1))
+				if size < 16 or len(fmt) < 16:
+					raise ValueError("Truncated format chunk in wave file %s" % infile)
+				tag, channels, rate, _, _, bits = struct.unpack('<HHIIHH', fmt[:16])
+				if tag == 0xFFFE and size >= 26:
+					# WAVE_FORMAT_EXTENSIBLE: the format tag starts the subformat GUID
+					tag = struct.unpack('<H', fmt[24:26])[0]
+				if (tag, bits) not in ((1, 8), (1, 16), (1, 24), (1, 32), (3, 32), (3, 64)):
+					raise ValueError("Unsupported wave format %d with %d bits: %s" % (tag, bits, infile))
+				info = dict(format='int' if tag == 1 else 'float', channels=channels,
+						sample_rate=rate, bits=bits)
+			elif chunk == 'data':
+				if info is None:
+					raise ValueError("Wave file without format chunk: %s" % infile)
+				info['offset'] = f.tell()
+				# streamed files may give no or a too large size
+				available = os.fstat(f.fileno()).st_size - info['offset']
+				info['size'] = min(size, available) if size else available
+				return info
+			else:
+				f.seek(size + (size & 1), 1)
+
+def decode_pcm(data, info):
+	"""Converts interleaved sample bytes of a wave file (see wave_info())
+	to float32 values in [-1, 1)."""
+	bits = info['bits']
+	data = data[:len(data) - len(data) % (bits // 8 * info['channels'])]
+	if info['format'] == 'float':
+		return np.frombuffer(data, dtype='<f%d' % (bits // 8)).astype(np.float32, copy=False)
+	elif bits == 8:
+		return ((np.frombuffer(data, dtype=np.uint8) - 128.) / 2.**7).astype(np.float32)
+	elif bits == 16:
+		return (np.frombuffer(data, dtype='<i2') / 2.**15).astype(np.float32)
+	elif bits == 24:
+		# place the three bytes of each sample in the upper bytes of an int32
+		samples = np.zeros((len(data) // 3, 4), dtype=np.uint8)
+		samples[:, 1:] = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+		return (samples.view('<i4')[:, 0] / 2.**31).astype(np.float32)
+	else:
+		return (np.frombuffer(data, dtype='<i4') / 2.**31).astype(np.float32)
+
+def split_channels(samples, num_channels, downmix=True):
+	"""Splits up interleaved samples into one row per channel, or mixes
+	them down to mono."""
 	if not downmix:
 		# just split up the interleaved samples into one row per channel
-		samples = samples.reshape((num_channels, -1), order='F')
+		return samples.reshape((num_channels, -1), order='F')
 	elif num_channels == 2:
 		# explicitly downmix stereo files
-		samples = (samples[::2] + samples[1::2]) / 2
+		return (samples[::2] + samples[1::2]) / 2
 	elif num_channels > 2:
 		raise ValueError("Unsupported wave file. Needs mono or stereo.")
 		# we could do a general downmix from the reshaped samples, but
 		# that's quite a bit slower than the explicit addition above.
 	return samples
 
+def resample_poly(samples, from_rate, to_rate):
+	"""Resamples along the last axis with a polyphase filter."""
+	from fractions import gcd
+	from scipy.signal import resample_poly
+	g = gcd(int(from_rate), int(to_rate))
+	return resample_poly(samples, int(to_rate) // g, int(from_rate) // g, axis=-1).astype(np.float32)
+
+def read_wave(infile, sample_rate, downmix=True, resample='ffmpeg'):
+	"""Reads a PCM or float .wav file. Files of another sample rate are
+	resampled for resample='poly', and rejected otherwise."""
+	info = wave_info(infile)
+	if info['sample_rate'] != sample_rate and resample != 'poly':
+		raise ValueError("Unsupported wave file. Needs %d Hz." % sample_rate)
+	if downmix and info['channels'] > 2:
+		raise ValueError("Unsupported wave file. Needs mono or stereo.")
+	with open(infile, 'rb') as f:
+		f.seek(info['offset'])
+		samples = decode_pcm(f.read(info['size']), info)
+	samples = split_channels(samples, info['channels'], downmix)
+	if info['sample_rate'] != sample_rate:
+		samples = resample_poly(samples, info['sample_rate'], sample_rate)
+	return samples
+
+def read_wave_blocks(infile, sample_rate, downmix=True, block_samples=65536):
+	"""Block-wise version of read_wave() (without resampling). Checks the
+	file right away and returns the shape of the signal without its time
+	axis, and an iterator over blocks of block_samples samples (the same
+	as read_wave() returns in one piece)."""
+	info = wave_info(infile)
+	num_channels = info['channels']
+	if info['sample_rate'] != sample_rate:
+		raise ValueError("Unsupported wave file. Needs %d Hz." % sample_rate)
+	if downmix and num_channels > 2:
+		raise ValueError("Unsupported wave file. Needs mono or stereo.")
+	def blocks():
+		with open(infile, 'rb') as f:
+			f.seek(info['offset'])
+			remaining = info['size']
+			block_bytes = block_samples * num_channels * (info['bits'] // 8)
+			while remaining > 0:
+				data = f.read(min(block_bytes, remaining))
+				if not data:
+					break
+				remaining -= len(data)
+				yield split_channels(decode_pcm(data, info), num_channels, downmix)
+	return (() if downmix else (num_channels,)), blocks()
+
+# decoder commands for files not read natively, in order of preference;
+# commands found to be missing are removed
+_decoders = ['avconv', 'ffmpeg']
+
+def with_decoder(read, *args, **kwargs):
+	"""Calls read_ffmpeg() or read_ffmpeg_blocks() with the first
+	available decoder command, so missing commands are tried only once
+	per process."""
+	while True:
+		cmd = _decoders[0]
+		try:
+			return read(*args, cmd=cmd, **kwargs)
+		except OSError:
+			if len(_decoders) == 1:
+				raise
+			_decoders.remove(cmd)
+
 def get_num_channels(infile, cmd='avprobe'):
 	import subprocess
 	info = subprocess.check_output([cmd, "-v", "quiet", "-show_streams", infile])
@@ -149,19 +338,58 @@ def read_ffmpeg(infile, sample_rate, downmix=True, cmd='avconv'):
 		samples = samples.reshape((num_channels, -1), order='F')
 	return samples	
 
+def read_ffmpeg_blocks(infile, sample_rate, downmix=True, cmd='avconv', block_samples=65536):
+	"""Block-wise version of read_ffmpeg(), reading from the decoder's pipe.
+	Returns the shape of the signal without its time axis, and an iterator
+	over blocks of block_samples samples."""
+	import subprocess
+	call = [cmd, "-v", "quiet", "-y", "-i", infile, "-f", "f32le", "-ar", str(sample_rate), "pipe:1"]
+	if downmix:
+		call[8:8] = ["-ac", "1"]
+		num_channels = 1
+	else:
+		num_channels = get_num_channels(infile, cmd[:2]+'probe') or 1
+	proc = subprocess.Popen(call, stdout=subprocess.PIPE)
+	def blocks():
+		try:
+			while True:
+				samples = proc.stdout.read(block_samples * num_channels * 4)
+				if not samples:
+					break
+				samples = np.frombuffer(samples, dtype=np.float32)
+				if not downmix:
+					samples = samples.reshape((num_channels, -1), order='F')
+				yield samples
+		finally:
+			proc.stdout.close()
+			if proc.wait():
+				raise subprocess.CalledProcessError(proc.returncode, call)
+	return (() if downmix else (num_channels,)), blocks()
+
+def read_audio(infile, sample_rate, downmix=True, resample='ffmpeg'):
+	"""Reads the samples of a .raw file, of a .wav file supported by
+	read_wave(), or of any other file via avconv/ffmpeg."""
+	if infile.endswith('.raw'):
+		return np.memmap(infile, dtype=np.float32)
+	try:
+		return read_wave(infile, sample_rate, downmix, resample)
+	except ValueError:
+		return with_decoder(read_ffmpeg, infile, sample_rate, downmix)
+
 
 class Phonify:
 	"""Convert dB SPL to phon units by applying the Terhardt outer ear transfer function.
 	The full scale signal dB SPL equivalent needs to be given on initialization (defaults as 96 dB)"""
 	def __init__(self,frqs,dB_max=96.,bias=1.e-8,clip=True):
 		self.frqs = frqs
+		self.bias = bias
 		self.todB = lambda x: self.lintodB(x,bias)
 		self.corr = self.terhardt_dB(frqs)-self.terhardt_dB(1000)+dB_max
 		self.clip = clip
 
 	@staticmethod
-	def lintodB(x,bias=1.e-8):
-		x = x+bias
+	def lintodB(x,bias=1.e-8,out=None):
+		x = np.add(x,bias,out=out)
 		np.log10(x,out=x)
 		x *= 20.
 		return x
@@ -172,41 +400,62 @@ class Phonify:
 		return -3.64*fk**-0.8 + 6.5*np.exp(-0.6*(fk-3.3)**2) - 1.e-3*(fk)**4
 
 	def __call__(self,frames,out=None):
+		"""Works in-place for out=frames; otherwise, out only needs a
+		temporary if its type differs from that of frames."""
 		frames = np.asarray(frames)
-		spec = self.todB(frames)
-
+		dtype = np.result_type(frames, self.bias)
 		if out is None:
-			out = np.empty_like(spec)
-		out[:] = spec
+			out = np.empty(frames.shape, dtype=dtype)
+		if out.dtype == dtype:
+			self.lintodB(frames,self.bias,out=out)
+		else:
+			out[:] = self.lintodB(frames,self.bias)
 		out += self.corr  # apply out-ear transfer function (equal-loudness contours)
 		if self.clip:
 			np.maximum(out, 0., out=out)  # clip values below the hearing threshold
 		return out # dB SPL
 
-def sonify(phons,out=None):
-	"""Convert phon to sone units"""
+def sonify(phons,out=None,block_size=1024):
+	"""Convert phon to sone units. Works in-place for out=phons, with
+	temporaries of at most block_size frames."""
 	phons = np.asarray(phons)
 	if out is None:
 		out = np.empty_like(phons)
-	out[:] = phons
-	out -= 40.
-	out *= 0.1
-	np.power(2.,out,out=out)
-	idx = out < 1. # out-of-place
-	small = phons[idx]
-	small *= (1./40.)
-	np.power(small,2.642,out=small)
-	out[idx] = small
+	if not phons.ndim:
+		sonify(phons.reshape(1), out.reshape(1), block_size)
+		return out
+	for pos in xrange(0, len(phons), max(1, int(block_size))):
+		p = phons[pos:pos+block_size]
+		o = out[pos:pos+block_size]
+		o[...] = p
+		o -= 40.
+		o *= 0.1
+		np.power(2.,o,out=o)
+		# below 1 sone, use a power law of the phons instead; for
+		# out=phons, these are read after the update above, as always
+		idx = o < 1.
+		small = p[idx]
+		small *= (1./40.)
+		np.power(small,2.642,out=small)
+		o[idx] = small
 	return out
 
-def logarithmize(spect, stretch=1.0, shift=0.0):
+def logarithmize(spect, stretch=1.0, shift=0.0, out=None, block_size=1024):
 	"""Returns log(shift + stretch * spect). Works in-place for non-complex
-	input, works only on the magnitudes and not in-place for complex input."""
+	input. For complex input, works only on the magnitudes and writes the
+	result to out (a new array by default, or spect itself), in blocks of
+	block_size frames."""
 	if np.iscomplexobj(spect):
-		phases = np.angle(spect)
-		spect = np.abs(spect)
-	else:
-		phases = None
+		if out is None:
+			out = np.empty_like(spect)
+		block_size = max(1, int(block_size))
+		for pos in xrange(0, len(spect), block_size):
+			# read the block before writing it, so out may be spect
+			block = spect[pos:pos+block_size]
+			phases = np.angle(block)
+			mags = logarithmize(np.abs(block), stretch, shift)
+			np.multiply(mags, np.exp(1.j*phases), out=out[pos:pos+block_size])
+		return out
 	if stretch != 1:
 		spect *= stretch
 	if shift == 0:
@@ -218,116 +467,303 @@ def logarithmize(spect, stretch=1.0, shift=0.0):
 	else:
 		spect += shift
 		np.log(spect, spect)
-	if phases is not None:
-		spect = spect * np.exp(1.j*phases)
 	return spect
 
 
 
-def filtered_stft(samples, framelen, hopsize, transmat, online=False, keep_phases=False, periodic_window=False, normalize_fft=False):
-	if periodic_window:
-		window = np.hanning(framelen+1)[1:]
-	else:
-		window = np.hanning(framelen)
+def frame_signal(samples, framelen, hopsize):
+	"""Returns a read-only strided view of `samples` holding one frame per
+	entry of the first axis, starting at every `hopsize` samples. For
+	multi-channel input of shape (channels, length), the view has shape
+	(frames, channels, framelen). No data is copied."""
+	hopsize = int(hopsize)
+	length = samples.shape[-1]
+	num_frames = max(0, (length - framelen + hopsize - 1) // hopsize)
+	stride = samples.strides[-1]
+	return as_strided(samples,
+			shape=(num_frames,) + samples.shape[:-1] + (framelen,),
+			strides=(hopsize * stride,) + samples.strides[:-1] + (stride,),
+			writeable=False)
 
-	if normalize_fft:
-		window *= 1./np.sqrt(np.mean(window**2))
-		window *= 2./framelen
+_windows = OrderedDict()
 
-	if samples.ndim == 1:
-		zeropad = np.zeros(framelen//2, dtype=samples.dtype)
-	else:
-		zeropad = np.zeros((samples.shape[0], framelen//2), dtype=samples.dtype)
-	if online:
-		samples = np.concatenate((zeropad, zeropad, samples))
-	else:
-		samples = np.concatenate((zeropad, samples, zeropad), axis=samples.ndim-1)
+def get_window(framelen, periodic=False, normalize=False, cache_size=16):
+	"""Returns a (read-only) Hann window, reusing windows computed before."""
+	key = (int(framelen), bool(periodic), bool(normalize))
+	try:
+		window = _windows.pop(key)
+	except KeyError:
+		if periodic:
+			window = np.hanning(framelen+1)[1:]
+		else:
+			window = np.hanning(framelen)
+		if normalize:
+			window *= 1./np.sqrt(np.mean(window**2))
+			window *= 2./framelen
+		window.flags.writeable = False
+	_windows[key] = window
+	while len(_windows) > cache_size:
+		_windows.popitem(last=False)
+	return window
 
+def stft_processor(transmat, channels_shape, framelen, keep_phases=False, block_size=1024, downmix=False):
+	"""Returns a function mapping a block of FFT frames to filtered
+	magnitudes (or complex values, for keep_phases). `transmat` can be
+	a slice of FFT bins, a transformation matrix or a FilterBank instance;
+	channels_shape is the shape of the signal without the time axis.
+	With downmix, the channels (the second axis) are averaged: magnitudes
+	before the projection, so it only runs on one channel, and complex
+	values after it."""
+	if downmix and not keep_phases:
+		magnitudes = lambda x: np.abs(x).mean(axis=1)
+		channels_shape = tuple(channels_shape)[1:]
+	else:
+		magnitudes = np.abs
+	# all functions below work on blocks of frames, along the last axis
 	if isinstance(transmat, slice):
 		if not keep_phases:
 			def process(x):
-				return np.abs(x)[transmat]
+				return magnitudes(x[...,transmat])
 		else:
 			def process(x):
-				return x[transmat]
+				return x[...,transmat]
 	else:
+		if isinstance(transmat, FilterBank):
+			# pick dense, sparse or banded application by a quick measurement
+			transform = transmat.fastest_transform((min(block_size, 256),)+tuple(channels_shape)+(framelen//2+1,))
+		else:
+			transform = lambda x: np.dot(x, transmat)
 		if not keep_phases:
 			def process(x):
-				return np.dot(np.abs(x), transmat)
+				return transform(magnitudes(x))
 		else:
 			def process(x):
-				m = np.dot(np.abs(x), transmat)
-				p = np.angle(np.dot(x, transmat))
+				m = transform(np.abs(x))
+				p = np.angle(transform(x))
 				return m * np.exp(1.j * p)
+	if downmix and keep_phases:
+		return lambda x: process(x).mean(axis=1)
+	return process
+
+def pad_signal(samples, framelen, online=False):
+	"""Zero-pads samples along the last axis as needed for the frames of
+	filtered_stft(): by half a frame on both sides, or by a full frame on
+	the left for online processing."""
 	if samples.ndim == 1:
-		spect = np.vstack(process(np.fft.rfft(samples[pos:pos+framelen] * window))
-				for pos in xrange(0, len(samples) - framelen, int(hopsize)))
+		zeropad = np.zeros(framelen//2, dtype=samples.dtype)
 	else:
-		spect = np.vstack(chain.from_iterable((process(np.fft.rfft(samp * window))
-				for samp in samples[:, pos:pos+framelen])
-				for pos in xrange(0, samples.shape[-1] - framelen, int(hopsize))))
-		spect = spect.reshape(-1, samples.shape[0], spect.shape[-1])
+		zeropad = np.zeros((samples.shape[0], framelen//2), dtype=samples.dtype)
+	if online:
+		return np.concatenate((zeropad, zeropad, samples), axis=samples.ndim-1)
+	else:
+		return np.concatenate((zeropad, samples, zeropad), axis=samples.ndim-1)
+
+def padded_part(padded, framelen, max_framelen, online=False):
+	"""Returns the view of a signal padded for max_framelen (see
+	pad_signal()) that equals the signal padded for framelen, so that
+	several frame lengths share one padded copy and the same hop grid."""
+	if online:
+		offset = 2*(max_framelen//2) - 2*(framelen//2)
+		return padded[..., offset:]
+	offset = max_framelen//2 - framelen//2
+	return padded[..., offset:padded.shape[-1]-offset]
+
+def filtered_stft(samples, framelen, hopsize, transmat, online=False, keep_phases=False, periodic_window=False, normalize_fft=False, block_size=1024, downmix=False, padded=False):
+	"""Computes the filtered STFT of `samples` (1-dimensional, or 2-dimensional
+	with one channel per row). Frames are processed in blocks of `block_size`
+	frames to bound the memory needed for temporaries. `transmat` can be
+	a slice of FFT bins, a transformation matrix or a FilterBank instance.
+	With downmix, channels are averaged (see stft_processor()). With
+	padded, `samples` have already been padded by pad_signal()."""
+	block_size = max(1, int(block_size))
+	window = get_window(framelen, periodic_window, normalize_fft)
+
+	if not padded:
+		samples = pad_signal(samples, framelen, online)
+
+	process = stft_processor(transmat, samples.shape[:-1], framelen, keep_phases, block_size, downmix)
+	frames = frame_signal(samples, framelen, hopsize)
+	spect = None
+	for pos in xrange(0, max(len(frames), 1), block_size):
+		block = process(np.fft.rfft(frames[pos:pos+block_size] * window))
+		if spect is None:
+			spect = np.empty((len(frames),)+block.shape[1:], dtype=block.dtype)
+		spect[pos:pos+block_size] = block
 	return spect
 
+def spect_bank(framelen, sample_rate, freq_scale='mel', bands=80, min_freq=27.5, max_freq=16000,
+		preserve_energy=False, bank_cache=''):
+	"""Returns the slice of FFT bins (for a linear frequency scale) or the
+	FilterBank used by compute_spect() for the given frame length."""
+	if freq_scale == 'linear':
+		fft_freqs = np.linspace(0, sample_rate / 2., num=framelen // 2 + 1)
+		low, high = np.searchsorted(fft_freqs, [min_freq, max_freq])
+		return slice(low, high)
+	return get_filterbank(framelen // 2 + 1, sample_rate, num_filters=bands, min_freq=min_freq, max_freq=max_freq, scale=freq_scale, shape='tri', dtype=np.double, preserve_energy=preserve_energy, cache_dir=bank_cache)
+
+def scale_spect(spect, bank, downmix=False, mag_scale=('log', 1.0, 0.0), keep_phases=False):
+	"""Downmixes and scales the magnitudes of a filtered STFT as in
+	compute_spect(). Works frame by frame, so it can be applied to blocks."""
+	if downmix:
+		spect = spect.mean(axis=1)
+	if mag_scale[0] == 'log':
+		spect = logarithmize(spect, stretch=mag_scale[1], shift=mag_scale[2], out=spect)
+	elif mag_scale[0] == 'power':
+		np.square(spect,out=spect)
+	elif mag_scale[0] in ('phon','sone'):
+		phonify = Phonify(bank.peaks_freq[1:-1],dB_max=mag_scale[1])
+		phonify(spect,out=spect)
+		if mag_scale[0] == 'sone':
+			sonify(spect,out=spect)
+	return spect.astype(np.float32 if not keep_phases else np.complex64)
+
 def compute_spect(samples, sample_rate, fps=100, framelens=(2048,),
 		freq_scale='mel', downmix=False, online=False, bands=80, min_freq=27.5, max_freq=16000,
-		mag_scale=('log', 1.0, 0.0), keep_phases=False, periodic_window=False, preserve_energy=False):
+		mag_scale=('log', 1.0, 0.0), keep_phases=False, periodic_window=False, preserve_energy=False,
+		block_size=1024, bank_cache=''):
 	# apply STFTs and mel bank and logarithmize
 	hopsize = sample_rate / fps
 	result = list()
 
+	# pad once for the longest frame; all frame lengths share the hop grid
+	max_framelen = max(framelens)
+	padded = pad_signal(samples, max_framelen, online)
 	for framelen in framelens:
-		if freq_scale == 'linear':
-			fft_freqs = np.linspace(0, sample_rate / 2., num=framelen // 2 + 1)
-			low, high = np.searchsorted(fft_freqs, [min_freq, max_freq])
-			bank = slice(low, high)
-		else:
-			bank = FilterBank(framelen // 2 + 1, sample_rate, num_filters=bands, min_freq=min_freq, max_freq=max_freq, scale=freq_scale, shape='tri', dtype=np.double, preserve_energy=preserve_energy)
-			bank = bank.as_matrix()
-		spect = filtered_stft(samples, framelen, hopsize, bank, online=online, keep_phases=keep_phases, periodic_window=periodic_window, normalize_fft=preserve_energy)
-		if downmix:
-			spect = spect.mean(axis=1)
-		if mag_scale[0] == 'log':
-			spect = logarithmize(spect, stretch=mag_scale[1], shift=mag_scale[2])
-		elif mag_scale[0] == 'power':
-			np.square(spect,out=spect)
-		elif mag_scale[0] in ('phon','sone'):
-			phonify = Phonify(bank.peaks_freq[1:-1],dB_max=mag_scale[1])
-			phonify(spect,out=spect)
-			if mag_scale[0] == 'sone':
-				sonify(spect,out=spect)
-		result.append(spect.astype(np.float32 if not keep_phases else np.complex64))
+		bank = spect_bank(framelen, sample_rate, freq_scale, bands, min_freq, max_freq, preserve_energy, bank_cache)
+		spect = filtered_stft(padded_part(padded, framelen, max_framelen, online), framelen, hopsize, bank,
+				keep_phases=keep_phases, periodic_window=periodic_window, normalize_fft=preserve_energy,
+				block_size=block_size, downmix=downmix and samples.ndim > 1, padded=True)
+		result.append(scale_spect(spect, bank, False, mag_scale, keep_phases))
 	return result
 
+class StreamingSTFT(object):
+	"""Computes the frames of filtered_stft() from a signal given in blocks
+	of samples, holding only the samples needed for the next frames.
+	Frames are processed in the same blocks of `block_size` frames as
+	filtered_stft(), so results are identical."""
+	def __init__(self, framelen, hopsize, transmat, channels_shape=(), online=False, keep_phases=False, periodic_window=False, normalize_fft=False, block_size=1024, downmix=False):
+		self.framelen = framelen
+		self.hopsize = int(hopsize)
+		self.block_size = max(1, int(block_size))
+		self.online = online
+		self.window = get_window(framelen, periodic_window, normalize_fft)
+		self.process = stft_processor(transmat, channels_shape, framelen, keep_phases, self.block_size, downmix)
+		self.zeropad = np.zeros(tuple(channels_shape)+(framelen//2,), dtype=np.float32)
+		# buffered samples, starting at sample self.start of the padded signal
+		self.buffer = np.concatenate((self.zeropad, self.zeropad), axis=-1) if online else self.zeropad
+		self.start = 0
+		self.frames = 0  # number of frames computed so far
+
+	def push(self, samples):
+		"""Adds a block of samples, returns a list of computed frame blocks."""
+		self.buffer = np.concatenate((self.buffer, samples.astype(self.buffer.dtype, copy=False)), axis=-1)
+		return self._compute(final=False)
+
+	def finish(self):
+		"""Ends the signal, returns a list of the remaining frame blocks."""
+		if not self.online:
+			self.buffer = np.concatenate((self.buffer, self.zeropad), axis=-1)
+		return self._compute(final=True)
+
+	def _compute(self, final):
+		# frames are complete if they end before the end of the buffer
+		# (frame_signal() does not include a frame ending at the signal end)
+		end = self.start + self.buffer.shape[-1]
+		available = max(0, (end - self.framelen + self.hopsize - 1) // self.hopsize)
+		blocks = []
+		while True:
+			stop = (self.frames // self.block_size + 1) * self.block_size
+			if stop > available:
+				if not final or (self.frames == available and (self.frames or blocks)):
+					break
+				stop = available
+			offset = self.frames * self.hopsize - self.start
+			frames = frame_signal(self.buffer[..., offset:], self.framelen, self.hopsize)[:stop-self.frames]
+			blocks.append(self.process(np.fft.rfft(frames * self.window)))
+			self.frames = stop
+			if final and stop == available:
+				break
+		# drop samples before the next frame
+		drop = self.frames * self.hopsize - self.start
+		if drop > 0:
+			self.buffer = self.buffer[..., drop:]
+			self.start += drop
+		return blocks
+
 def extract_melspect(infile, sample_rate, **args):
 	# read input samples
 	downmix = (args['downmix'] == 'before')
-	if infile.endswith('.raw'):
-		samples = np.memmap(infile, dtype=np.float32)
-	else:
-		try:
-			samples = read_wave(infile, sample_rate, downmix)
-		except (wave.Error, ValueError):
-			try:
-				samples = read_ffmpeg(infile, sample_rate, downmix)
-			except OSError:
-				samples = read_ffmpeg(infile, sample_rate, downmix, cmd='ffmpeg')
+	resample = args.pop('resample', 'ffmpeg')
+	samples = read_audio(infile, sample_rate, downmix, resample)
 	# transform signal to spectrum
 	args['downmix'] = (args['downmix'] == 'after')
 	return compute_spect(samples, sample_rate, **args)
 
-def main():
-	# parse command line
-	parser = opts_parser()
-	options, args = parser.parse_args()
-	if len(args) != 2:
-		parser.error("missing INFILE or OUTFILE")
-	infile, outfile = args
-	framelens = map(int, options.frame_lengths.split(','))
+def batch_melspect(infiles, sample_rate, **args):
+	"""Batch version of extract_melspect(): returns its results for a list
+	of input files. Single-channel signals of equal length are transformed
+	together, as the channels of one signal, so their STFTs and filterbank
+	projections run as one vectorized computation."""
+	downmix = args['downmix']
+	resample = args.pop('resample', 'ffmpeg')
+	signals = [read_audio(infile, sample_rate, downmix == 'before', resample) for infile in infiles]
+	results = [None] * len(infiles)
+	# group single-channel signals by length
+	groups = OrderedDict()
+	for i, samples in enumerate(signals):
+		if samples.ndim == 1 or len(samples) == 1:
+			groups.setdefault(samples.shape[-1], []).append(i)
+		else:
+			results[i] = compute_spect(samples, sample_rate, **dict(args, downmix=(downmix == 'after')))
+	args['downmix'] = False
+	block_size = args.get('block_size', 1024)
+	for idxs in groups.itervalues():
+		# keep the temporaries of a block of frames as large as for a single signal
+		args['block_size'] = max(1, block_size // len(idxs))
+		spects = compute_spect(np.vstack([signals[i] for i in idxs]), sample_rate, **args)
+		for j, i in enumerate(idxs):
+			# without downmix, a single channel keeps its axis
+			keep = (signals[i].ndim > 1 and not downmix)
+			results[i] = [np.ascontiguousarray(spect[:, j:j+1] if keep else spect[:, j]) for spect in spects]
+	return results
 
-	if (len(framelens) > 1) and (outfile.endswith('.npy')):
-		parser.error(".npy output not supported for more than one frame length")
+def stream_melspect(infile, sample_rate, **args):
+	"""Streaming version of extract_melspect(): reads the input in blocks
+	and yields (index, spectrogram block) pairs, with the index into the
+	frame lengths. Concatenating the blocks of each frame length gives the
+	result of extract_melspect()."""
+	downmix = (args['downmix'] == 'before')
+	hopsize = sample_rate / args['fps']
+	block_size = max(1, int(args['block_size']))
+	block_samples = block_size * int(hopsize)
+	if infile.endswith('.raw'):
+		signal = np.memmap(infile, dtype=np.float32)
+		channels = ()
+		blocks = (signal[pos:pos+block_samples] for pos in xrange(0, len(signal), block_samples))
+	else:
+		try:
+			channels, blocks = read_wave_blocks(infile, sample_rate, downmix, block_samples)
+		except ValueError:
+			channels, blocks = with_decoder(read_ffmpeg_blocks, infile, sample_rate, downmix, block_samples=block_samples)
+	streams = []
+	for framelen in args['framelens']:
+		bank = spect_bank(framelen, sample_rate, args['freq_scale'], args['bands'], args['min_freq'], args['max_freq'], args['preserve_energy'], args['bank_cache'])
+		stream = StreamingSTFT(framelen, hopsize, bank, channels, online=args['online'], keep_phases=args['keep_phases'],
+				periodic_window=args['periodic_window'], normalize_fft=args['preserve_energy'], block_size=block_size,
+				downmix=args['downmix'] == 'after' and len(channels) > 0)
+		streams.append((stream, bank))
+	scale = lambda spect, bank: scale_spect(spect, bank, False, args['mag_scale'], args['keep_phases'])
+	for samples in blocks:
+		for i, (stream, bank) in enumerate(streams):
+			for spect in stream.push(samples):
+				yield i, scale(spect, bank)
+	for i, (stream, bank) in enumerate(streams):
+		for spect in stream.finish():
+			yield i, scale(spect, bank)
 
+def extract_options(options):
+	"""Returns the keyword arguments for extract_melspect() corresponding
+	to the parsed command line options."""
 	if options.mag_scale == 'linear':
 		mag_scale = ('linear',)
 	elif options.mag_scale == 'log':
@@ -336,55 +772,396 @@ def main():
 		mag_scale = (options.mag_scale, options.db_max)
 		options.preserve_energy = True
 
-	# call extract_melspect()
 	if options.channels == 'mix-before':
 		downmix = 'before'
 	elif options.channels == 'mix-after':
 		downmix = 'after'
 	else:
 		downmix = False
-	spects = extract_melspect(infile, options.sample_rate,
-			fps=options.frame_rate, framelens=framelens,
+	return dict(fps=options.frame_rate,
+			framelens=map(int, options.frame_lengths.split(',')),
 			downmix=downmix, online=options.online,
 			freq_scale=options.freq_scale, bands=options.bands,
 			min_freq=options.min_freq, max_freq=options.max_freq,
 			mag_scale=mag_scale, keep_phases=options.keep_phases,
 			periodic_window=options.preserve_energy,
-			preserve_energy=options.preserve_energy)
+			preserve_energy=options.preserve_energy,
+			block_size=options.block_size,
+			resample=options.resample,
+			bank_cache=options.bank_cache)
+
+def output_data(spects, framelens, options):
+	"""Returns the spectrograms computed by extract_melspect() as a list of
+	(name, matrix) pairs to be written out, excluding time stamps, in the
+	storage type given by --dtype (with scale and offset scalars for uint8)."""
+	data = [(options.featname % {'len': flen}, spect) for flen, spect in izip(framelens, spects)]
+	if options.channels == 'split':
+		data = sum(([(n + '.' + str(i), spect[:,i]) for i in xrange(spect.shape[1])]
+				for n, spect in data), [])
+	return quantize_data(data, options.dtype)
+
+def dataset_options(options, shape):
+	"""Returns the h5py create_dataset() arguments for chunking and
+	compression of a dataset of the given shape."""
+	if options.compression == 'none' and not options.chunk_frames:
+		return {}
+	if not len(shape) or not np.prod(shape):
+		return {}  # scalars and empty datasets cannot be chunked
+	chunk_frames = options.chunk_frames or 1024
+	kwargs = dict(chunks=(max(1, min(chunk_frames, shape[0])),)+tuple(shape[1:]))
+	if options.compression != 'none':
+		kwargs['compression'] = options.compression
+		if options.compression == 'gzip':
+			kwargs['compression_opts'] = options.compression_level
+	return kwargs
+
+def output_times(num_frames, framelens, options):
+	"""Returns the time stamps of num_frames spectrogram frames, as
+	selected by --times-mode."""
+	dt = 1./options.frame_rate
+	times = np.arange(num_frames+1,dtype=np.float32)*dt
+	if options.times_mode == 'beginnings':
+		times = times[:-1]
+	elif options.times_mode == 'centers':
+		# shift times to bin centers
+		times = times[:-1]+dt/2.
+	elif options.times_mode == 'borders':
+		pass
+	elif options.times_mode == 'borders2':
+		# give the left and right border per frame
+		times = np.vstack((times[:-1], times[:-1] + float(framelens[0]) / options.sample_rate)).T
+	else:
+		raise NotImplementedError("Option --times-mode choice '%s' unhandled."%options.times_mode)
+	return times
+
+def write_output(outfile, spects, framelens, options, attrs=()):
+	"""Writes the spectrograms computed by extract_melspect() to outfile.
+	For .h5 files, the options and any further (name, value) pairs in attrs
+	are stored as attributes. The output is written to a temporary file
+	first and renamed, so outfile is never left incomplete."""
+	tmpfile = '%s.%i.tmp' % (outfile, os.getpid())
+	try:
+		_write_output(tmpfile, outfile, spects, framelens, options, attrs)
+		os.rename(tmpfile, outfile)
+	except Exception:
+		if os.path.exists(tmpfile):
+			os.remove(tmpfile)
+		raise
 
-	# write to output file
+def _write_output(tmpfile, outfile, spects, framelens, options, attrs):
+	"""Writes to tmpfile in the format given by the extension of outfile."""
 	if outfile.endswith('.npy'):
-		np.save(outfile, spects[0])
+		with open(tmpfile, 'wb') as f:
+			np.save(f, quantize(spects[0], options.dtype)[0])
 	else:
-		data = [(options.featname % {'len': flen}, spect) for flen, spect in izip(framelens, spects)]
-		if options.channels == 'split':
-			data = sum(([(n + '.' + str(i), spect[:,i]) for i in xrange(spect.shape[1])]
-					for n, spect in data), [])
+		data = output_data(spects, framelens, options)
 		if options.include_times:
-			dt = 1./options.frame_rate
-			times = np.arange(len(spects[0])+1,dtype=np.float32)*dt
-			if options.times_mode == 'beginnings':
-				times = times[:-1]
-			elif options.times_mode == 'centers':
-				# shift times to bin centers
-				times = times[:-1]+dt/2.
-			elif options.times_mode == 'borders':
-				pass
-			elif options.times_mode == 'borders2':
-				# give the left and right border per frame
-				times = np.vstack((times[:-1], times[:-1] + float(framelens[0]) / options.sample_rate)).T
-			else:
-				raise NotImplementedError("Option --times-mode choice '%s' unhandled."%options.times_mode)
-			data.append(('times', times))
+			data.append(('times', output_times(len(spects[0]), framelens, options)))
 		if outfile.endswith('.h5'):
 			import h5py
-			with h5py.File(outfile, 'w') as f:
+			with h5py.File(tmpfile, 'w') as f:
 				for k, v in data:
-					f[k] = v
+					f.create_dataset(k, data=v, **dataset_options(options, np.shape(v)))
 				for k, v in options.__dict__.iteritems():
 					f.attrs[k] = v
+				for k, v in attrs:
+					f.attrs[k] = v
 		else:
-			np.savez(outfile, **dict(data))
+			with open(tmpfile, 'wb') as f:
+				(np.savez if options.compression == 'none' else np.savez_compressed)(f, **dict(data))
+
+# options that do not influence the computed spectrograms
+_io_options = ('manifest', 'input_glob', 'output_dir', 'output_suffix', 'store',
+		'jobs', 'overwrite', 'block_size', 'bank_cache', 'stream', 'compression',
+		'compression_level', 'chunk_frames')
+
+# options added after params_hash(), hashed only if differing from their
+# defaults, so that existing outputs stay valid
+_hash_defaults = dict(dtype='float32', resample='ffmpeg')
+
+def params_hash(options):
+	"""Returns a hash of all options that influence the computed
+	spectrograms, for validating existing outputs."""
+	import hashlib
+	extract_options(options)  # sets dependent options
+	params = sorted((k, v) for k, v in options.__dict__.iteritems()
+			if k not in _io_options and (k not in _hash_defaults or v != _hash_defaults[k]))
+	return hashlib.sha1(repr(params)).hexdigest()
+
+def source_signature(infile):
+	"""Returns the (size, mtime) of infile."""
+	st = os.stat(infile)
+	return st.st_size, st.st_mtime
+
+def is_current(outfile, phash, source):
+	"""Returns whether outfile exists and, for .h5 files, was computed with
+	parameter hash phash from a source file with signature source (see
+	process_file). Other formats are only checked for existence."""
+	if not os.path.exists(outfile):
+		return False
+	if not outfile.endswith('.h5'):
+		return True
+	import h5py
+	try:
+		with h5py.File(outfile, 'r') as f:
+			return (f.attrs.get('params_hash') == phash and
+					f.attrs.get('source_size') == source[0] and
+					f.attrs.get('source_mtime') == source[1])
+	except (IOError, OSError):
+		# unreadable, e.g., truncated by a crash
+		return False
+
+def stream_file(infile, outfile, options):
+	"""Computes the spectrograms of infile block by block (see
+	stream_melspect()), appending them to resizable datasets of the .h5
+	file outfile. Writes the same data and attributes as process_file().
+	Returns the duration of the audio in seconds."""
+	import h5py
+	args = extract_options(options)
+	source = source_signature(infile)
+	tmpfile = '%s.%i.tmp' % (outfile, os.getpid())
+	try:
+		with h5py.File(tmpfile, 'w') as f:
+			num_frames = 0
+			for i, spect in stream_melspect(infile, options.sample_rate, **args):
+				for name, v in output_data([spect], [args['framelens'][i]], options):
+					if name not in f:
+						kwargs = dataset_options(options, (options.chunk_frames or 1024,)+v.shape[1:])
+						kwargs.setdefault('chunks', (1024,)+v.shape[1:])
+						f.create_dataset(name, shape=(0,)+v.shape[1:], maxshape=(None,)+v.shape[1:], dtype=v.dtype, **kwargs)
+					ds = f[name]
+					ds.resize(len(ds)+len(v), axis=0)
+					ds[len(ds)-len(v):] = v
+				if i == 0:
+					num_frames += len(spect)
+			if options.include_times:
+				f['times'] = output_times(num_frames, args['framelens'], options)
+			for k, v in options.__dict__.iteritems():
+				f.attrs[k] = v
+			for k, v in [('params_hash', params_hash(options)), ('source_size', source[0]), ('source_mtime', source[1])]:
+				f.attrs[k] = v
+		os.rename(tmpfile, outfile)
+	except Exception:
+		if os.path.exists(tmpfile):
+			os.remove(tmpfile)
+		raise
+	return num_frames / options.frame_rate
+
+def process_file(infile, outfile, options):
+	"""Computes the spectrograms of infile and writes them to outfile, or
+	returns them as output_data() for outfile=None.
+	Returns the duration of the audio in seconds (and the data)."""
+	if options.stream and outfile is not None and outfile.endswith('.h5'):
+		return stream_file(infile, outfile, options)
+	args = extract_options(options)
+	source = source_signature(infile)
+	spects = extract_melspect(infile, options.sample_rate, **args)
+	duration = len(spects[0]) / options.frame_rate
+	if outfile is None:
+		return duration, output_data(spects, args['framelens'], options)
+	attrs = [('params_hash', params_hash(options)), ('source_size', source[0]), ('source_mtime', source[1])]
+	write_output(outfile, spects, args['framelens'], options, attrs)
+	return duration
+
+def batch_jobs(options):
+	"""Returns the list of (infile, outfile) pairs given by the --manifest
+	or --input-glob options. With --store, outfile is the store file."""
+	import glob
+	jobs = []
+	if options.manifest:
+		with open(options.manifest, 'r') as f:
+			for ln in f:
+				ln = ln.strip()
+				if ln and not ln.startswith('#'):
+					infile, outfile = ln.rsplit(',', 1)
+					jobs.append((infile.strip(), outfile.strip()))
+	if options.input_glob:
+		for infile in sorted(glob.glob(options.input_glob)):
+			# mirror the dataset subdirectory: OUTDIR/<dataset>/<file><suffix>
+			# or OUTDIR/<dataset>.store.h5 for stores
+			subdir = os.path.basename(os.path.dirname(infile))
+			if options.store:
+				outfile = os.path.join(options.output_dir, subdir+STORE_SUFFIX)
+			else:
+				outfile = os.path.join(options.output_dir, subdir, os.path.basename(infile)+options.output_suffix)
+			jobs.append((infile, outfile))
+	return jobs
+
+_batch_options = None
+
+def _batch_init(options):
+	global _batch_options
+	_batch_options = options
+
+def _batch_process(job):
+	"""Processes a single batch job, catching and returning any error.
+	For --store, the computed data is returned instead of written."""
+	infile, outfile = job
+	data = None
+	try:
+		if _batch_options.store:
+			duration, data = process_file(infile, None, _batch_options)
+		else:
+			outdir = os.path.dirname(outfile)
+			if outdir and not os.path.isdir(outdir):
+				try:
+					os.makedirs(outdir)
+				except OSError:
+					pass  # may have been created by another worker
+			duration = process_file(infile, outfile, _batch_options)
+	except Exception:
+		import traceback
+		return infile, outfile, 0., traceback.format_exc(), None
+	return infile, outfile, duration, None, data
+
+def _open_stores(jobs, options, phash, sources):
+	"""Prepares the spectrogram stores of a --store batch. A store with
+	stale or missing entries is rebuilt in a temporary file: its valid
+	entries are copied over, the others are left to be computed.
+	Returns a dict of outfile => (new store, temporary file name), with
+	(None, None) for stores that are up to date, and the set of jobs with
+	valid entries."""
+	storejobs = {}
+	for infile, outfile in jobs:
+		storejobs.setdefault(outfile, []).append(infile)
+	stores = {}
+	valid = set()
+	for outfile, infiles in sorted(storejobs.iteritems()):
+		old = None
+		if os.path.exists(outfile) and not options.overwrite:
+			try:
+				old = SpectStore(outfile, 'r')
+			except (IOError, OSError):
+				pass  # unreadable, rebuild
+		if old is not None and old.attrs.get('params_hash') != phash:
+			old.close()
+			old = None
+		keep = []
+		if old is not None:
+			current = [i for i in infiles if old.source(os.path.basename(i)) == sources[i]]
+			if len(current) == len(infiles):
+				# nothing to compute
+				valid.update((i, outfile) for i in infiles)
+				stores[outfile] = (None, None)
+				old.close()
+				continue
+			valid.update((i, outfile) for i in current)
+			# keep valid entries and those of files not in the batch
+			listed = set(os.path.basename(i) for i in infiles)
+			keep = sorted(set(os.path.basename(i) for i in current) |
+					set(k for k in old.keys() if k not in listed))
+		outdir = os.path.dirname(outfile)
+		if outdir and not os.path.isdir(outdir):
+			os.makedirs(outdir)
+		tmpfile = '%s.%i.tmp' % (outfile, os.getpid())
+		kwargs = dataset_options(options, (options.chunk_frames or 1024,))
+		store = SpectStore(tmpfile, 'w', chunk_frames=kwargs.get('chunks', (1024,))[0],
+				compression=kwargs.get('compression'), compression_opts=kwargs.get('compression_opts'))
+		store.attrs['framerate'] = options.frame_rate
+		for k, v in options.__dict__.iteritems():
+			store.attrs[k] = v
+		store.attrs['params_hash'] = phash
+		for k in keep:
+			store.append(k, [(name, old.read(k, name)) for name in old.names+old.scalars.keys()], source=old.source(k))
+		if old is not None:
+			old.close()
+		stores[outfile] = (store, tmpfile)
+	return stores, valid
+
+def run_batch(jobs, options):
+	"""Processes all (infile, outfile) pairs in jobs, in options.jobs parallel
+	processes. Failures are reported, but do not stop the batch.
+	Existing outputs are skipped if they were computed with the same
+	spectral parameters from the same version (size and modification
+	time) of their input file.
+	With options.store, results are appended to spectrogram stores by this
+	process, keyed by the input file name.
+	Returns the number of failed files."""
+	from timeit import default_timer
+	start = default_timer()
+	phash = params_hash(options)
+	sources = dict((i, source_signature(i)) for i in set(i for i, _ in jobs))
+	stores = {}
+	if options.store:
+		stores, valid = _open_stores(jobs, options, phash, sources)
+		todo = [(i, o) for i, o in jobs if (i, o) not in valid]
+	elif not options.overwrite:
+		todo = [(i, o) for i, o in jobs if not is_current(o, phash, sources[i])]
+	else:
+		todo = jobs
+	skipped = len(jobs) - len(todo)
+	if options.jobs > 1:
+		import multiprocessing
+		pool = multiprocessing.Pool(options.jobs, initializer=_batch_init, initargs=(options,))
+		results = pool.imap_unordered(_batch_process, todo, chunksize=4)
+	else:
+		pool = None
+		_batch_init(options)
+		results = imap(_batch_process, todo)
+	done = failed = 0
+	duration = 0.
+	for infile, outfile, dur, error, data in results:
+		if error is None and data is not None:
+			try:
+				stores[outfile][0].append(os.path.basename(infile), data, source=sources[infile])
+			except ValueError as exc:
+				error = str(exc)
+		if error is None:
+			done += 1
+			duration += dur
+		else:
+			failed += 1
+			print >>sys.stderr, "Failed making %s from %s:\n%s" % (outfile, infile, error)
+	if pool is not None:
+		pool.close()
+		pool.join()
+	for outfile, (store, tmpfile) in stores.iteritems():
+		if store is not None:
+			# replace the store only when complete
+			store.close()
+			os.rename(tmpfile, outfile)
+	elapsed = default_timer() - start
+	print >>sys.stderr, "Made %i files (%i up to date, %i failed) in %.1f s: %.2f files/s, %.4f audio hours/s" % \
+			(done, skipped, failed, elapsed, done / max(elapsed, 1.e-6), duration / 3600. / max(elapsed, 1.e-6))
+	return failed
+
+def main():
+	# parse command line
+	parser = opts_parser()
+	options, args = parser.parse_args()
+	if options.dtype != 'float32' and options.keep_phases:
+		parser.error("--dtype %s does not support --keep-phases" % options.dtype)
+	if options.dtype == 'uint8' and options.stream:
+		parser.error("--dtype uint8 cannot be combined with --stream")
+	if options.manifest or options.input_glob:
+		# batch mode
+		if args:
+			parser.error("INFILE and OUTFILE cannot be given in batch mode")
+		if options.input_glob and not options.output_dir:
+			parser.error("--input-glob needs --output-dir")
+		if options.stream and options.store:
+			parser.error("--stream cannot be combined with --store")
+		jobs = batch_jobs(options)
+		if options.stream and any(not o.endswith('.h5') for _, o in jobs):
+			parser.error("--stream needs .h5 output files")
+		if options.dtype == 'uint8' and any(o.endswith('.npy') for _, o in jobs):
+			parser.error(".npy output not supported for --dtype uint8")
+		if (len(options.frame_lengths.split(',')) > 1) and any(o.endswith('.npy') for _, o in jobs):
+			parser.error(".npy output not supported for more than one frame length")
+		sys.exit(1 if run_batch(jobs, options) else 0)
+
+	if len(args) != 2:
+		parser.error("missing INFILE or OUTFILE")
+	infile, outfile = args
+
+	if (len(options.frame_lengths.split(',')) > 1) and (outfile.endswith('.npy')):
+		parser.error(".npy output not supported for more than one frame length")
+	if options.stream and not outfile.endswith('.h5'):
+		parser.error("--stream needs an .h5 output file")
+	if options.dtype == 'uint8' and outfile.endswith('.npy'):
+		parser.error(".npy output not supported for --dtype uint8")
+
+	process_file(infile, outfile, options)
 
 if __name__=="__main__":
 	main()
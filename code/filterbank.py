@@ -8,6 +8,8 @@ Author: Jan Schlüter and Thomas Grill
 """
 
 import numpy as np
+import os
+from collections import OrderedDict
 
 def mel_spaced_frequencies(count, min_freq, max_freq):
 	"""
@@ -118,6 +120,27 @@ class FilterBank(object):
 			# Append to the list of filters
 			self._filters.append((l, filt))
 
+	@classmethod
+	def from_banded(cls, length, sample_rate, peaks_freq, starts, lengths, coeffs):
+		"""
+		Recreates a filterbank instance from its banded form (see as_banded),
+		without recomputing the filters.
+		@param length: Length of frames (in samples) the bank is to be
+			applied to
+		@param sample_rate: Sample rate of input data
+		@param peaks_freq: Peak frequencies of the bank, including the
+			outermost cutoff frequencies
+		"""
+		self = cls.__new__(cls)
+		self.sample_rate = sample_rate
+		self.length = length
+		self.num_filters = len(starts)
+		self.dtype = coeffs.dtype
+		self.peaks_freq = peaks_freq
+		offsets = np.concatenate(([0], np.cumsum(lengths)))
+		self._filters = [(l, coeffs[o:o+n]) for l, o, n in zip(starts, offsets, lengths)]
+		return self
+
 	def as_matrix(self,sparse=False):
 		"""
 		Returns the filterbank as a transformation matrix of shape
@@ -136,30 +159,179 @@ class FilterBank(object):
 			mat = csr_matrix(mat)
 		return mat
 
+	def as_banded(self):
+		"""
+		Returns the filterbank in a compact banded form.
+		@return A tuple (starts, lengths, coeffs) giving the first input bin
+			and the number of bins of each filter, and the coefficients of
+			all filters packed into a single vector.
+		"""
+		starts = np.array([l for l, _ in self._filters], dtype=np.intp)
+		lengths = np.array([len(filt) for _, filt in self._filters], dtype=np.intp)
+		coeffs = np.concatenate([filt for _, filt in self._filters]+[np.empty(0, dtype=self.dtype)])
+		return starts, lengths, coeffs
+
+	def _banded_layers(self):
+		"""
+		Splits the filters into layers of non-overlapping filters (two
+		layers for triangular filters, each one spanning the peaks of its
+		neighbours). Each layer is represented as a tuple (filters, bounds,
+		weights) of filter indices, the first input bin of each filter and
+		a weight vector holding the coefficients of all filters in the layer.
+		"""
+		try:
+			return self._layers
+		except AttributeError:
+			pass
+		starts, lengths, coeffs = self.as_banded()
+		offsets = np.concatenate(([0], np.cumsum(lengths)))
+		layers = []  # lists of [end, filter indices]
+		for b in np.argsort(starts, kind='mergesort'):
+			if not lengths[b]:
+				continue  # empty filters are handled in apply
+			for layer in layers:
+				if layer[0] <= starts[b]:
+					break
+			else:
+				layer = [0, []]
+				layers.append(layer)
+			layer[0] = starts[b]+lengths[b]
+			layer[1].append(b)
+		self._layers = []
+		for _, filters in layers:
+			filters = np.asarray(filters, dtype=np.intp)
+			weights = np.zeros(self.length, dtype=self.dtype)
+			for b in filters:
+				weights[starts[b]:starts[b]+lengths[b]] = coeffs[offsets[b]:offsets[b+1]]
+			self._layers.append((filters, starts[filters], weights))
+		return self._layers
+
 	def apply(self, data):
 		"""
-		Applies the filterbank to the given input data. This is meant to be
-		more efficient than a dot product with the filter matrix, but it can
-		actually be slower (depending on your BLAS implementation).
-		@param data: Input data as a 1-dimensional or 2-dimensional matrix.
-			For 2-dimensional matrices, input frames are expected in rows.
-			Each row must have a length equal to self.length (as specified
+		Applies the filterbank to the given input data. Within each layer of
+		non-overlapping filters (see _banded_layers), all filters are applied
+		by a single element-wise product and segment sum, which only touches
+		each input bin once per layer.
+		@param data: Input data as a 1-, 2- or 3-dimensional matrix.
+			Input frames are expected in the last dimension, such as
+			(frames, bins) or (frames, channels, bins).
+			Each frame must have a length equal to self.length (as specified
 			in the filterbank constructor).
-		@return The transformed input data; again in rows, same dtype as input.
+		@return The transformed input data; again with frames in the last
+			dimension, same dtype as input.
 		"""
-		if len(data.shape) not in (1,2):
-			raise ValueError("Only handles 1- and 2-dimensional data, got %d dimensions." % len(data.shape))
+		if len(data.shape) not in (1,2,3):
+			raise ValueError("Only handles 1-, 2- and 3-dimensional data, got %d dimensions." % len(data.shape))
 		if data.shape[-1] != self.length:
 			raise ValueError("Expected data.shape[-1] of %d, got %d." % (self.length, data.shape[-1]))
-		# For performance reasons, we handle 1 and 2 dimensions separately
-		# (this allows us to use np.dot in the 1D case)
-		if len(data.shape) == 1:
-			outdata = np.empty(self.num_filters, dtype=data.dtype)
-			for b, (l, filt) in enumerate(self._filters):
-				outdata[b] = np.dot(data[l:l+len(filt)], filt)
-		elif len(data.shape) == 2:
-			outdata = np.empty((data.shape[0], self.num_filters), dtype=data.dtype)
-			for b, (l, filt) in enumerate(self._filters):
-				outdata[:,b] = (data[:,l:l+len(filt)] * filt).sum(axis=1)
+		# filters with no coefficients (narrower than one bin) yield zeros
+		outdata = np.zeros(data.shape[:-1]+(self.num_filters,), dtype=data.dtype)
+		if data.size:
+			for filters, bounds, weights in self._banded_layers():
+				outdata[...,filters] = np.add.reduceat(data*weights, bounds, axis=-1)
 		return outdata
 
+	def transform(self, method='banded'):
+		"""
+		Returns a function applying the filterbank to data with input
+		frames in the last dimension.
+		@param method: 'dense' for a dot product with the transformation
+			matrix, 'sparse' for a product with the CSR matrix, or 'banded'
+			for self.apply
+		"""
+		try:
+			transforms = self._transforms
+		except AttributeError:
+			transforms = self._transforms = {}
+		if method in transforms:
+			return transforms[method]
+		if method == 'dense':
+			mat = self.as_matrix()
+			transform = lambda data: np.dot(data, mat)
+		elif method == 'sparse':
+			matT = self.as_matrix(sparse=True).T.tocsr()
+			def transform(data):
+				flat = data.reshape(-1, self.length)
+				return matT.dot(flat.T).T.reshape(data.shape[:-1]+(self.num_filters,))
+		elif method == 'banded':
+			transform = self.apply
+		else:
+			raise ValueError("Unsupported filterbank method '%s'."%method)
+		transforms[method] = transform
+		return transform
+
+	def fastest_transform(self, shape, dtype=np.double, methods=('dense', 'sparse', 'banded')):
+		"""
+		Returns the fastest of the given transform methods (see transform),
+		timed once on data of the given shape. The choice is remembered for
+		data of the same frame layout (i.e., regardless of shape[0]).
+		"""
+		key = (tuple(shape[1:]), np.dtype(dtype))
+		try:
+			fastest = self._fastest
+		except AttributeError:
+			fastest = self._fastest = {}
+		if key not in fastest:
+			from timeit import default_timer
+			data = np.ones(shape, dtype=dtype)
+			timings = []
+			for method in methods:
+				try:
+					fun = self.transform(method)
+				except ImportError:
+					continue  # scipy is not available for sparse matrices
+				fun(data[:1])  # warm up
+				start = default_timer()
+				fun(data)
+				timings.append((default_timer()-start, method))
+			fastest[key] = self.transform(min(timings)[1])
+		return fastest[key]
+
+
+# process-wide cache of filterbank instances (see get_filterbank)
+_cache = OrderedDict()
+cache_size = 16
+
+def get_filterbank(length, sample_rate, num_filters, min_freq=130.0, max_freq=6854.0, norm=True, scale='mel', shape='tri', dtype=np.double, preserve_energy=False, cache_dir=''):
+	"""
+	Returns a FilterBank instance for the given parameters (see
+	FilterBank.__init__), reusing instances created before in this process.
+	Reused instances also keep their matrices and banded layers. At most
+	`cache_size` instances are kept, dropping the least recently used one.
+	@param cache_dir: If given, the banded form of the bank is also stored
+		in a .npz file in this directory, from which other processes can
+		load it without recomputing the filters.
+	"""
+	key = (int(length), float(sample_rate), int(num_filters), float(min_freq), float(max_freq),
+			bool(norm), scale, shape, np.dtype(dtype).name, bool(preserve_energy))
+	try:
+		bank = _cache.pop(key)
+	except KeyError:
+		bank = None
+		if cache_dir:
+			fn = os.path.join(cache_dir, 'filterbank_%s.npz'%'_'.join(str(k) for k in key))
+			try:
+				with np.load(fn) as f:
+					bank = FilterBank.from_banded(key[0], key[1], f['peaks_freq'], f['starts'], f['lengths'], f['coeffs'])
+			except (IOError, ValueError, KeyError):
+				pass
+		if bank is None:
+			bank = FilterBank(length, sample_rate, num_filters, min_freq=min_freq, max_freq=max_freq, norm=norm, scale=scale, shape=shape, dtype=dtype, preserve_energy=preserve_energy)
+			if cache_dir:
+				# write to a temporary file first, so that concurrent readers don't see partial files
+				tmpfn = '%s.%i.tmp'%(fn, os.getpid())
+				starts, lengths, coeffs = bank.as_banded()
+				try:
+					with open(tmpfn, 'wb') as f:
+						np.savez(f, peaks_freq=bank.peaks_freq, starts=starts, lengths=lengths, coeffs=coeffs)
+					os.rename(tmpfn, fn)
+				except (IOError, OSError):
+					# the cache is only an optimization, keep the computed bank
+					try:
+						os.remove(tmpfn)
+					except OSError:
+						pass
+	_cache[key] = bank
+	while len(_cache) > cache_size:
+		_cache.popitem(last=False)
+	return bank
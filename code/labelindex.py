@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compiled index of label files: the labels of all given CSV files
+(itemid,datasetid,hasbird) as a sorted array of ids and a float32 array
+of values, looked up by binary search. The index can be stored in a .npz
+file, which is rebuilt only when the label files change.
+"""
+
+import numpy as np
+import glob
+import os
+import logging
+
+
+def expand_labelfiles(labelfiles):
+    """Returns the label file names given by wildcards and/or comma-separated lists, in order."""
+    fns = []
+    for fnpat in labelfiles.split(','):
+        if fnpat.strip():
+            fns.extend(fn for fn in sorted(glob.glob(fnpat.strip())) if fn not in fns)
+    return fns
+
+
+def parse_labelfile(fn):
+    """
+    Returns the ids (as <dataset>/<item> without extension) and label
+    values of a label file. Lines without numeric labels (such as headers)
+    are skipped. Items without path get the file name as dataset.
+    """
+    fid = os.path.splitext(os.path.split(fn)[-1])[0]
+    ids = []
+    values = []
+    with open(fn) as f:
+        for ln in f:
+            i,_,l = ln.strip().split(',')
+            try:
+                lval = float(l)
+            except ValueError:
+                # not a float
+                continue
+            p,i = os.path.split(i)
+            i = os.path.splitext(i)[0] # no extension
+            ids.append(os.path.join(p or fid, i))
+            values.append(lval)
+    return ids, values
+
+
+class LabelIndex(object):
+    """
+    Sorted label ids with their values. Supports dict-style lookup of single
+    ids and vectorized lookup of many.
+    """
+
+    def __init__(self, ids, values):
+        self.ids = np.asarray(ids, dtype=str)
+        self.values = np.asarray(values, dtype=np.float32)
+
+    @classmethod
+    def from_lists(cls, ids, values):
+        """
+        Creates an index from ids and values in file order. Later entries
+        override earlier ones; conflicting values are reported in one summary.
+        """
+        ids = np.asarray(ids, dtype=str)
+        values = np.asarray(values, dtype=np.float32)
+        order = np.argsort(ids, kind='mergesort') # stable, keeps file order per id
+        ids = ids[order]
+        values = values[order]
+        last = np.ones(len(ids), dtype=bool)
+        last[:-1] = ids[1:] != ids[:-1]
+        # conflicts: ids with differing values
+        conflict = (ids[1:] == ids[:-1]) & (values[1:] != values[:-1])
+        if conflict.any():
+            conflicting = np.unique(ids[1:][conflict])
+            logging.warning("%i label IDs present with different values, e.g., %s"%(len(conflicting), ', '.join(conflicting[:5])))
+        return cls(ids[last], values[last])
+
+    @classmethod
+    def from_files(cls, fns):
+        ids = []
+        values = []
+        for fn in fns:
+            i, v = parse_labelfile(fn)
+            ids.extend(i)
+            values.extend(v)
+        return cls.from_lists(ids, values)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, ids):
+        """
+        Returns the values for an array of ids, and a boolean mask
+        of ids found in the index (values of others are NaN).
+        """
+        ids = np.asarray(ids, dtype=str)
+        if not len(self.ids):
+            return np.full(ids.shape, np.nan, dtype=np.float32), np.zeros(ids.shape, dtype=bool)
+        pos = np.minimum(np.searchsorted(self.ids, ids), len(self.ids)-1)
+        found = self.ids[pos] == ids
+        return np.where(found, self.values[pos], np.float32(np.nan)), found
+
+    def __contains__(self, i):
+        pos = np.searchsorted(self.ids, i)
+        return pos < len(self.ids) and self.ids[pos] == i
+
+    def __getitem__(self, i):
+        pos = np.searchsorted(self.ids, i)
+        if pos < len(self.ids) and self.ids[pos] == i:
+            return float(self.values[pos])
+        raise KeyError(i)
+
+
+def load_labels(labelfiles, index_file=''):
+    """
+    Returns a LabelIndex for the label files given by wildcards and/or
+    comma-separated lists. If index_file is given, the index is read from
+    there, unless the set of label files or their modification times changed,
+    in which case it is rebuilt and stored.
+    """
+    fns = expand_labelfiles(labelfiles)
+    mtimes = np.asarray([os.path.getmtime(fn) for fn in fns], dtype=np.float64)
+    if index_file:
+        try:
+            with np.load(index_file) as f:
+                if list(f['sources']) == fns and np.array_equal(f['mtimes'], mtimes):
+                    return LabelIndex(f['ids'], f['values'])
+        except (IOError, KeyError, ValueError):
+            pass
+        logging.info("Building label index %s from %i files"%(index_file, len(fns)))
+    index = LabelIndex.from_files(fns)
+    if index_file:
+        # write to a temporary file first, so that concurrent readers don't see partial files
+        tmpfn = '%s.%i.tmp'%(index_file, os.getpid())
+        with open(tmpfn, 'wb') as f:
+            np.savez(f, ids=index.ids, values=index.values, sources=np.asarray(fns, dtype=str), mtimes=mtimes)
+        os.rename(tmpfn, index_file)
+    return index
@@ -1,13 +1,19 @@
 import numpy as np
 import logging
-import glob
 import os
 import random
 import itertools
+from numpy.lib.stride_tricks import as_strided
+import threading
+import timeit
+from collections import OrderedDict, deque
 import urllib
 import sys
 import pdb
 # local module
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import spectstore
+import labelindex
 
 
 def loopspec(spec, width, offs=0):
@@ -28,6 +34,24 @@ def loopspec(spec, width, offs=0):
                 yield spec[offs+o:offs+o+width]
 
 
+def loopspec_batch(spec, width, offs=0):
+    """
+    Returns all windows produced by loopspec(spec, width, offs) as a single
+    array of shape (windows, width, ...). If no window wraps around, this is
+    a strided view of spec, otherwise the windows are gathered in one step.
+    """
+    if not width:
+        return spec[np.newaxis]
+    assert width > 0
+
+    starts = np.arange(0, len(spec), width)+offs
+    if not len(starts) or (offs >= 0 and starts[-1]+width <= len(spec)):
+        return as_strided(spec[offs:], shape=(len(starts),width)+spec.shape[1:], strides=(width*spec.strides[0],)+spec.strides)
+    idxs = starts[:,np.newaxis]+np.arange(width)
+    idxs %= len(spec)
+    return spec[idxs]
+
+
 def process_cut(spect, stddevs=3, ignore=2):
     from scipy.ndimage.filters import maximum_filter1d
     # "loudness" curve
@@ -43,14 +67,91 @@ def process_cut(spect, stddevs=3, ignore=2):
     return cut_front,cut_back+1
 
 
-def process_denoise(spect, mode='mean'):
+def denoise_correction(spect, mode='mean'):
     if mode == 'mean':
         corr = np.mean(spect, axis=0)
     elif mode == 'median':
         corr = np.median(spect, axis=0)
     else:
         raise ValueError('Mode unknown')
-    return spect-corr
+    return corr
+
+
+def process_denoise(spect, mode='mean'):
+    return spect-denoise_correction(spect, mode=mode)
+
+
+def read_prepstats(fn, cut_stddevs, cut_ignore, denoise_mode):
+    """
+    Reads precomputed cut bounds and denoising corrections (see make_prepstats.py),
+    checking that they were computed with the given parameters.
+    Returns a dict mapping file ids to (cut_low, cut_high, correction).
+    """
+    import h5py
+    with h5py.File(fn, 'r') as f5:
+        attrs = dict(f5.attrs)
+        if attrs['cut_stddevs'] != cut_stddevs or (cut_stddevs > 0 and attrs['cut_ignore'] != cut_ignore):
+            raise ValueError("Cut parameters of %s (cut_stddevs=%g, cut_ignore=%i) don't match"%(fn, attrs['cut_stddevs'], attrs['cut_ignore']))
+        if denoise_mode is not None and attrs['denoise_mode'] != denoise_mode:
+            raise ValueError("Denoise mode of %s ('%s') doesn't match"%(fn, attrs['denoise_mode']))
+        return dict(itertools.izip(f5['id'][:], itertools.izip(f5['cut_low'][:], f5['cut_high'][:], f5['corr'][:])))
+
+
+def nbytes(obj):
+    """Approximate memory size of arrays contained in obj, in bytes."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.itervalues())
+    elif isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    else:
+        return 0
+
+
+class LRUCache(object):
+    """
+    Cache evicting the least recently used items once the contained arrays
+    exceed max_bytes (0 = unlimited).
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock() # for prefetching threads
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value, size = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.items[key] = (value, size) # most recently used
+            self.hits += 1
+            return value
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def put(self, key, value):
+        size = nbytes(value)
+        if self.max_bytes and size > self.max_bytes:
+            return # would evict everything else
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items.pop(key)[1]
+            self.items[key] = (value, size)
+            self.bytes += size
+            while self.max_bytes and self.bytes > self.max_bytes:
+                _, (_, size) = self.items.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        return "%i items, %.1f MB, %i hits, %i misses, %i evictions"%(len(self.items), self.bytes/2.**20, self.hits, self.misses, self.evictions)
 
 
 try:
@@ -62,10 +163,11 @@ else:
         assert column == -1
     
         data_type = util.getarg(args, 'type', label=label)
-        if data_type not in ('audio','spect'):
+        if data_type not in ('audio','spect','melspect'):
             raise ValueError("load_data needs data_type option")
         
         labelfiles = util.getarg(args, 'labels', '', label=label, dtype=str) # wildcards and/or comma-separated
+        labels_index = util.getarg(args, 'labels_index', '', label=label, dtype=str) # compiled label index file (.npz), rebuilt if labels change
         targets_needed = util.getarg(args, 'targets_needed', True, label=label, dtype=bool)
         data_path = util.getarg(args, 'data', '', label=label, dtype=str)
         data_vars = util.getarg(args, 'data_vars', '', label=label, dtype=str)
@@ -77,9 +179,12 @@ else:
         seed = util.getarg(args, 'seed', -1, label=label, dtype=int)
         cycle = util.getarg(args, 'cycle', 0, label=label, dtype=int)
         cache = util.getarg(args, 'cache', False, label=label, dtype=bool)
+        cache_mb = util.getarg(args, 'cache_mb', 0., label=label, dtype=float) # cache size limit (0 = unlimited)
+        cache_stage = util.getarg(args, 'cache_stage', 'raw', label=label, dtype=str) # cache 'raw' file data or 'processed' (cut/denoised) data
         eqgain = util.getarg(args, 'eqgain', 0., label=label, dtype=float)
         width = util.getarg(args, 'width', 0, label=label, dtype=int)
         offset = util.getarg(args, 'offset', 0, label=label, dtype=int)
+        emit_batches = util.getarg(args, 'emit_batches', False, label=label, dtype=bool) # yield all windows of an item at once
         useweights = util.getarg(args, 'weights', False, label=label, dtype=bool)
         lmbda = util.getarg(args, 'lambda', 1., label=label, dtype=float)
 
@@ -92,63 +197,139 @@ else:
         denoise = util.getarg(args, 'denoise', False, label=label, dtype=bool)
         denoise_mode = util.getarg(args, 'denoise_mode', 'mean', label=label, dtype=str)
 
+        workers = util.getarg(args, 'workers', 0, label=label, dtype=int) # number of loading threads (0 = load in the calling thread)
+        prefetch = util.getarg(args, 'prefetch', 2*workers, label=label, dtype=int) # number of items loaded ahead
+        prepstats_file = util.getarg(args, 'prepstats', '', label=label, dtype=str) # precomputed cut bounds and denoising (make_prepstats.py)
+
+        # memory-mapped reading of .npy files and contiguous stores
+        mmap = util.getarg(args, 'mmap', False, label=label, dtype=bool)
+        framerate = util.getarg(args, 'framerate', 0., label=label, dtype=float) # for data without time stamps (.npy)
+
+        # mel spectrograms computed from audio files on the fly (type=melspect), as by prepare_spectrograms.sh
+        spect_sr = util.getarg(args, 'spect_sr', 22050, label=label, dtype=int)
+        spect_fps = util.getarg(args, 'spect_fps', 70., label=label, dtype=float)
+        spect_fftlen = util.getarg(args, 'spect_fftlen', 1024, label=label, dtype=int)
+        spect_fmin = util.getarg(args, 'spect_fmin', 50., label=label, dtype=float)
+        spect_fmax = util.getarg(args, 'spect_fmax', 11000., label=label, dtype=float)
+        spect_bands = util.getarg(args, 'spect_bands', 80, label=label, dtype=int)
+        spect_resample = util.getarg(args, 'spect_resample', 'ffmpeg', label=label, dtype=str)
+        spect_batch = util.getarg(args, 'spect_batch', 1, label=label, dtype=int) # number of items computed together (see benchmark.py features)
+
         rng = random.Random(seed if seed >= 0 else None)
         classes = classes.split(',')
 
         # read all available labels
-        labels = {}
-        for fns in labelfiles.split(','):
-            if fns.strip():
-                for fn in glob.glob(fns):
-                    fid = os.path.splitext(os.path.split(fn)[-1])[0]
-                    with open(fn) as f:
-                        for ln in f:
-                            i,_,l = ln.strip().split(',')
-                            p,i = os.path.split(i)
-                            i = os.path.splitext(i)[0] # no extension
-                            if not p:
-                                p = fid
-                            ifull = os.path.join(p,i)
-                            try:
-                                lval = float(l)
-                            except ValueError:
-                                # not a float
-                                continue
-                            if ifull in labels and labels[ifull] != lval:
-                                logging.warning("Label ID %s already present with different value (%f != %f)"%(ifull,labels[ifull],lval))
-                            labels[ifull] = lval # true/false
+        labels = labelindex.load_labels(labelfiles, index_file=labels_index)
 
         # data variations
         data_vars = data_vars.split(',')
 
-        cachemem = {}        
-        for item in data:
-            info = item[-1]
-            fileid = info['id']
-            fileid_noext = os.path.splitext(fileid)[0]       
+        if prepstats_file:
+            if len(data_vars) > 1:
+                raise ValueError("prepstats can only be used with a single data variation")
+            prepstats = read_prepstats(prepstats_file, cut_stddevs, cut_ignore, denoise_mode if denoise else None)
+            logging.debug("Read precomputed statistics for %i files from %s"%(len(prepstats), prepstats_file))
+        else:
+            prepstats = {}
+
+        if cache_stage not in ('raw', 'processed'):
+            raise ValueError("Cache stage '%s' unknown"%cache_stage)
+        cachemem = LRUCache(max_bytes=int(cache_mb*2**20)) if cache or cache_mb > 0 else None
+
+        if data_type == 'melspect':
+            import extract_melspect
+            spect_options, _ = extract_melspect.opts_parser().parse_args(['--channels=mix-after', '-r', str(spect_sr),
+                '-f', str(spect_fps), '-l', str(spect_fftlen), '-t', 'mel', '-m', str(spect_fmin), '-M', str(spect_fmax),
+                '-b', str(spect_bands), '-s', 'log', '--resample', spect_resample])
+            spect_args = extract_melspect.extract_options(spect_options)
+            # items are loaded in chunks, computing their spectrograms in one batch
+            chunk_size = max(1, spect_batch)
+        else:
+            chunk_size = 1
+        computed = {} # spectrograms of a chunk (file name => matrix), until read by read_input
+
+        def cached(key):
+            return cachemem is not None and key in cachemem
+
+        def read_input(fn, fileid_name):
+            """Reads one input file (or store entry), returns (inp_data, meta)"""
+            if not os.path.exists(fn):
+                raise ValueError("No file found for input path '%s'"%fn)
+
+            if spectstore.is_store(fn):
+                store = spectstore.get_store(fn, mmap=mmap)
+                if fileid_name not in store:
+                    raise ValueError("No entry '%s' found in store '%s'"%(fileid_name, fn))
+                cachekey = (fn, fileid_name)
+            else:
+                store = None
+                cachekey = fn
+
+            if cachemem is not None and cache_stage == 'raw':
+                try:
+                    return cachemem.get(cachekey)
+                except KeyError:
+                    pass
+            try:
+                if store is not None:
+                    inp_data, meta = store.load(fileid_name), None
+                elif data_type == 'melspect':
+                    spect = computed.pop(fn, None)
+                    if spect is None:
+                        spect = extract_melspect.extract_melspect(fn, spect_sr, **dict(spect_args))[0]
+                    inp_data, meta = dict(features=spect), None
+                elif mmap and fn.endswith('.npy'):
+                    inp_data, meta = dict(features=np.load(fn, mmap_mode='r')), None
+                else:
+                    inp_data, meta = util.load(fn, args=args, metadata=True, label=label)
+            except IOError:
+                print >>sys.stderr, "Input file %s is broken"%fn
+                raise
+            if cachemem is not None and cache_stage == 'raw':
+                cachemem.put(cachekey, (inp_data, meta))
+            return inp_data, meta
+
+        def item_paths(fileid):
+            """Returns the input file names of a file id, one per data variation"""
+            fileid_noext = os.path.splitext(fileid)[0]
             fileid_class = os.path.split(fileid_noext)[0]
+            fileid_name = os.path.split(fileid)[1]
 
             # fileid has subpaths
-            fns = [data_path%dict(id=fileid, id_noext=fileid_noext, var=v) for v in data_vars]
+            # spectrogram stores are named by dataset, e.g., data=/spect/%(dataset)s.store.h5
+            return [data_path%dict(id=fileid, id_noext=fileid_noext, dataset=fileid_class, name=fileid_name, var=v) for v in data_vars]
+
+        def compute_chunk(fileids):
+            """Computes the spectrograms of not yet cached inputs of file ids in one batch, for read_input"""
+            fns = []
+            for fileid in fileids:
+                if cache_stage == 'processed' and cached(fileid):
+                    continue
+                for fn in item_paths(fileid):
+                    if fn not in fns and fn not in computed and not cached(fn) and os.path.exists(fn):
+                        fns.append(fn)
+            if len(fns) > 1:
+                for fn, spects in zip(fns, extract_melspect.batch_melspect(fns, spect_sr, **dict(spect_args))):
+                    computed[fn] = spects[0]
+
+        def load_item(fileid):
+            """Loads, cuts, denoises and pads all inputs of a file id, returns (inps, corr, meta, fns)"""
+            if cachemem is not None and cache_stage == 'processed':
+                try:
+                    return cachemem.get(fileid)
+                except KeyError:
+                    pass
+
+            fileid_name = os.path.split(fileid)[1]
+            fns = item_paths(fileid)
 
             samplerate = None
             inps = []
+            corrs = []
             cut_low = []
             cut_high = []
             for fn in fns:
-                if not os.path.exists(fn):
-                    raise ValueError("No file found for input path '%s'"%fn)
-
-                try:
-                    inp_data, meta = cachemem[fn]
-                except KeyError:
-                    try:
-                        inp_data, meta = util.load(fn, args=args, metadata=True, label=label)
-                    except IOError:
-                        print >>sys.stderr, "Input file %s is broken"%fn
-                        raise
-                if cache:
-                    cachemem[fn] = (inp_data, meta)
+                inp_data, meta = read_input(fn, fileid_name)
                 logging.debug("Loaded input file '%s': %s'"%(fileid, fn))
 
                 # target processing
@@ -156,18 +337,32 @@ else:
                     samplerate = meta['samplerate']
                     inp = inp_data
                 else:
-                    samplerate = 1./np.diff(inp_data['times']).mean()
-                    inp = inp_data['features']
+                    if 'times' in inp_data:
+                        samplerate = 1./np.diff(inp_data['times']).mean()
+                    elif data_type == 'melspect':
+                        samplerate = spect_fps
+                    else:
+                        samplerate = framerate
+                    # float32 features (restoring quantized ones)
+                    inp = spectstore.dequantize(inp_data, 'features')
             
+                stats = prepstats.get(fileid)
+
                 if cut_stddevs > 0:
-                    low,high = process_cut(inp, stddevs=cut_stddevs, ignore=cut_ignore)
+                    if stats is not None:
+                        low,high = stats[:2]
+                    else:
+                        low,high = process_cut(inp, stddevs=cut_stddevs, ignore=cut_ignore)
                     inp = inp[low:high]
                     cut_low.append(low)
                     cut_high.append(high)
             
                 if denoise:
                     # 'denoise' by subtracting the average over time
-                    inp = process_denoise(inp, mode=denoise_mode)
+                    if stats is not None:
+                        corrs.append(stats[2])
+                    else:
+                        corrs.append(denoise_correction(inp, mode=denoise_mode))
                 
                 inps.append(inp)
 
@@ -175,9 +370,23 @@ else:
                 low_max = max(cut_low)
                 high_min = min(cut_high)
                 inps = [inp[low_max-low:high_min-high or None] for inp,low,high in zip(inps,cut_low,cut_high)]
-       
+
+            # Without downmix and zero padding, the denoising correction commutes
+            # with the steps below and is only subtracted from the yielded windows.
+            # Otherwise, a single input stays a view of the (possibly memory-mapped) data.
+            if corrs and (downmix or (pad_mode == 'zero' and pad_front+pad_back+multiple > 1)):
+                inps = [inp-corr for inp,corr in zip(inps,corrs)]
+                corr = None
+            elif corrs:
+                corr = np.asarray(corrs)
+            else:
+                corr = None
+
             # time must be first axis
-            inps = np.asarray(inps).swapaxes(0,1)
+            if len(inps) == 1:
+                inps = inps[0][:,np.newaxis]
+            else:
+                inps = np.asarray(inps).swapaxes(0,1)
 
             if downmix:
                 # mix down channels but keep dimensionality
@@ -211,6 +420,58 @@ else:
         
                 inps = np.concatenate((pad_data_front, inps, pad_data_back), axis=0)
 
+            if cachemem is not None and cache_stage == 'processed':
+                cachemem.put(fileid, (inps, corr, meta, fns))
+            return inps, corr, meta, fns
+
+        def load_chunk(fileids):
+            """Returns the load_item results of a chunk of file ids"""
+            if chunk_size > 1:
+                compute_chunk(fileids)
+            return [load_item(fileid) for fileid in fileids]
+
+        def loaded_items(data):
+            """Yields (item, load_item result) pairs in input order, loading chunks of
+            chunk_size items, up to 'prefetch' items (rounded up to chunks) ahead in
+            'workers' threads"""
+            data = iter(data)
+            chunks = iter(lambda: list(itertools.islice(data, chunk_size)), [])
+            if workers <= 0:
+                for chunk in chunks:
+                    for item, loaded in zip(chunk, load_chunk([item[-1]['id'] for item in chunk])):
+                        yield item, loaded
+                return
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(workers)
+            pending = deque()
+            try:
+                for chunk in chunks:
+                    pending.append((chunk, pool.apply_async(load_chunk, ([item[-1]['id'] for item in chunk],))))
+                    if len(pending) > -(-prefetch//chunk_size):
+                        chunk, result = pending.popleft()
+                        for item, loaded in zip(chunk, result.get()): # re-raises errors of the worker
+                            yield item, loaded
+                while pending:
+                    chunk, result = pending.popleft()
+                    for item, loaded in zip(chunk, result.get()):
+                        yield item, loaded
+            finally:
+                pool.terminate()
+
+        starttime = timeit.default_timer()
+        for itemnr, (item, loaded) in enumerate(loaded_items(data)):
+            info = item[-1]
+            fileid = info['id']
+            fileid_noext = os.path.splitext(fileid)[0]
+            fileid_class = os.path.split(fileid_noext)[0]
+
+            inps, corr, meta, fns = loaded
+
+            if itemnr % 1000 == 999:
+                logging.debug("load_data: %i items, %.1f items/s"%(itemnr+1, (itemnr+1)/(timeit.default_timer()-starttime)))
+                if cachemem is not None:
+                    logging.debug("load_data cache: %s"%cachemem.stats())
+
             try:
                 tgt = labels[fileid_noext]
             except KeyError:
@@ -237,11 +498,24 @@ else:
 
             for variation in xrange(cycle or 1):
                 offs = offset+(rng.randint(1, len(inps)-1) if variation else 0)
-                for vinps in loopspec(inps, width, offs):
-                    # augment using equalization and colored noise
-                    if eqgain:
-                        # use a sine curve with random phase and eqgain amplitude to modulate the spectrum
-                        eq = np.sin((np.arange(vinps.shape[1],dtype=np.float32)/vinps.shape[1]+rng.random())*np.pi*2)*(eqgain*0.5)
-                        vinps = vinps+eq
-
-                    yield tuple([inp for inp in vinps.swapaxes(0,1)]+[outp] + weights + [info])
+                windows = loopspec_batch(inps, width, offs)
+                if corr is not None:
+                    windows = windows-corr
+                elif cachemem is not None or not windows.flags.writeable:
+                    # copy windows of cached or memory-mapped data, so consumers
+                    # changing them in place do not alter later epochs
+                    windows = windows.copy()
+
+                # augment using equalization and colored noise
+                if eqgain:
+                    # use a sine curve with random phase and eqgain amplitude to modulate the spectrum
+                    phases = np.asarray([rng.random() for _ in xrange(len(windows))], dtype=np.float32)
+                    eq = np.sin((np.arange(windows.shape[2],dtype=np.float32)/windows.shape[2]+phases[:,np.newaxis])*np.pi*2)*(eqgain*0.5)
+                    windows = windows+eq[:,np.newaxis,np.newaxis]
+
+                if emit_batches:
+                    # one tuple for all windows, with a leading window axis
+                    yield tuple([windows[:,:,i] for i in xrange(windows.shape[2])]+[np.repeat(o[np.newaxis], len(windows), axis=0) for o in [outp]+weights] + [info])
+                else:
+                    for vinps in windows:
+                        yield tuple([inp for inp in vinps.swapaxes(0,1)]+[outp] + weights + [info])
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""
+Precomputes the cut bounds and denoising corrections of load_data.py
+for all spectrograms, so that training only needs to slice and subtract
+(see the prepstats option of load_data.py).
+
+Inputs are spectrogram stores (<dataset>.store.h5) or directories with
+one spectrogram file per clip (<dir>/<dataset>/<clip>.h5, as written by
+prepare_spectrograms.sh). Entries are keyed by file id (<dataset>/<clip>).
+"""
+
+import numpy as np
+import h5py
+import glob
+import os
+import sys
+
+import spectstore
+from load_data import process_cut, denoise_correction
+
+import argparse
+parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+parser.add_argument("out", type=str, help="output file (.h5)")
+parser.add_argument("inputs", nargs='+', type=str, help="spectrogram stores or directories")
+parser.add_argument("--feature", type=str, default='features', help="feature name (default='%(default)s')")
+parser.add_argument("--cut-stddevs", type=float, default=0, help="cut_stddevs option of load_data.py, 0 for no cutting (default=%(default)s)")
+parser.add_argument("--cut-ignore", type=int, default=4, help="cut_ignore option of load_data.py (default=%(default)s)")
+parser.add_argument("--denoise-mode", choices=('mean','median'), default='mean', help="denoise_mode option of load_data.py (default='%(default)s')")
+parser.add_argument("--jobs", type=int, default=1, help="Number of parallel processes (default=%(default)s)")
+args = parser.parse_args()
+
+
+def compute_stats(job):
+    """Returns (fileid, cut_low, cut_high, correction) for a (fileid, path, key) job"""
+    fileid, path, key = job
+    if key is not None:
+        store = spectstore.get_store(path)
+        data = dict((k, store.read(key, k)) for k in (args.feature, args.feature+'_scale', args.feature+'_offset')
+                    if k in store.names or k in store.scalars)
+    else:
+        with h5py.File(path, 'r') as f5:
+            data = dict((k, f5[k][()]) for k in (args.feature, args.feature+'_scale', args.feature+'_offset') if k in f5)
+    spect = spectstore.dequantize(data, args.feature)
+    if args.cut_stddevs > 0:
+        low, high = process_cut(spect, stddevs=args.cut_stddevs, ignore=args.cut_ignore)
+    else:
+        low, high = 0, len(spect)
+    return fileid, low, high, denoise_correction(spect[low:high], mode=args.denoise_mode)
+
+
+jobs = []
+for inp in args.inputs:
+    if spectstore.is_store(inp):
+        dataset = os.path.basename(inp)[:-len(spectstore.STORE_SUFFIX)]
+        with spectstore.SpectStore(inp) as store:
+            keys = sorted(store.keys())
+        jobs.extend((dataset+'/'+k, inp, k) for k in keys)
+    else:
+        for fn in sorted(glob.glob(os.path.join(inp, '*', '*.h5'))):
+            fileid = os.path.relpath(fn, inp)[:-len('.h5')]
+            jobs.append((fileid, fn, None))
+
+print >>sys.stderr, "Computing statistics for %i spectrograms"%len(jobs)
+if args.jobs > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(args.jobs)
+    results = pool.map(compute_stats, jobs, chunksize=16)
+    pool.close()
+else:
+    results = map(compute_stats, jobs)
+results.sort()
+
+with h5py.File(args.out, 'w') as f5:
+    f5.create_dataset('id', data=[r[0] for r in results], dtype=h5py.special_dtype(vlen=str))
+    f5['cut_low'] = np.asarray([r[1] for r in results], dtype=np.int64)
+    f5['cut_high'] = np.asarray([r[2] for r in results], dtype=np.int64)
+    f5['corr'] = np.asarray([r[3] for r in results])
+    f5.attrs['cut_stddevs'] = args.cut_stddevs
+    f5.attrs['cut_ignore'] = args.cut_ignore
+    f5.attrs['denoise_mode'] = args.denoise_mode
+    f5.attrs['feature'] = args.feature
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 
+import numpy as np
+import json
 import random
 import sys
+
+import predtable
+
 import argparse
 parser = argparse.ArgumentParser()
 parser.add_argument("filelist", type=str, help="filelist file")
@@ -12,6 +17,11 @@ parser.add_argument("--out", type=str, help="Out file template (default='%(defau
 parser.add_argument("--out-prefix-filelists", type=str, help="original filelists with out item prefixes included, for re-appending")
 parser.add_argument("--out-suffix", type=str, default='', help="out item suffix (default='%(default)s')")
 parser.add_argument("--out-header", action='store_true', help="write eventual filelist header")
+parser.add_argument("--sweep", type=str, help="Instead of writing filelists, report pseudo-label yields for a grid of thresholds (start:stop:step or comma-separated)")
+parser.add_argument("--gt", type=str, help="Ground truth file(s) for the precision of pseudo-labels in the sweep (comma-separated)")
+parser.add_argument("--gt-suffix", type=str, default='', help="suffix for items in ground-truth file(s) (default='%(default)s')")
+parser.add_argument("--val-predictions", type=str, help="Validation predictions (with header) to report in the sweep, labeled by --gt")
+parser.add_argument("--report", type=str, help="Sweep report file, JSON if ending in .json, otherwise CSV (default=stdout)")
 args = parser.parse_args()
 
 fnin = args.filelist
@@ -19,28 +29,128 @@ thr = args.threshold
 folds = args.folds
 fnout = args.out
 
-out_prefixes = {}
-for opfn in args.out_prefix_filelists.split(','):
-    with open(opfn, 'r') as f:
-        f.next()
-        for ln in f:
-            k,datasetid,v = ln.strip().split(',')
-            out_prefixes[k] = datasetid
-
-ok = lambda r: r <= thr or r >= 1.-thr
-
-hdr = None
-with open(fnin, 'r') as fin:
-    if args.filelist_header:
-        hdr = fin.next()
-    ids = [(id,rt) for id,rt in (ln.strip().split(',') for ln in fin) if ok(float(rt))]
-
-random.shuffle(ids)
-
-for fold in range(folds):
-    fn = fnout%(dict(fold=fold+1))
-    with open(fn, 'w') as fout:
-        if args.out_header and hdr is not None:
-            fout.write(hdr.split(',')[0,2:])
-        for id, rt in ids[fold::folds]:
-            print >>fout, "%s/%s%s,%s,%s" % (out_prefixes[id], id, args.out_suffix, out_prefixes[id], rt)
+
+def parse_thresholds(spec):
+    """Returns the thresholds given as start:stop:step (including stop) or comma-separated list"""
+    if ':' in spec:
+        start, stop, step = map(float, spec.split(':'))
+        return np.round(np.arange(start, stop+step/2., step), 10)
+    return np.asarray([float(t) for t in spec.split(',')])
+
+
+def sweep(table, thresholds, source):
+    """
+    Counts the items each threshold would pseudo-label, per dataset and per
+    class, in one sorted pass over the predictions, along with the precision
+    of the pseudo-labels of items with labels.
+    Returns the report rows as dicts.
+    """
+    if table.dataset is None:
+        codes = np.zeros(len(table), dtype=np.int32)
+        names = np.asarray(['all'])
+    else:
+        codes = table.dataset
+        names = table.datasets
+    label = table.label if table.label is not None else np.full(len(table), np.nan, dtype=np.float32)
+    # sort by dataset, then prediction (which lies in [0,1])
+    keys = 2.*codes+table.pred.astype(np.float64)
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    label = label[order]
+    # cumulative counts of items labeled negative, positive, and labeled at all
+    cumcount = lambda m: np.concatenate(([0], np.cumsum(m)))
+    with np.errstate(invalid='ignore'): # unlabeled items are NaN
+        cumneg = cumcount(label < .5)
+        cumpos = cumcount(label >= .5)
+    cumlab = cumcount(~np.isnan(label))
+    # same float32 comparisons as when writing filelists
+    base = 2.*np.arange(len(names))[:,np.newaxis]
+    start = np.searchsorted(keys, base)
+    end = np.searchsorted(keys, base+2.)
+    negend = np.searchsorted(keys, base+np.float32(thresholds).astype(np.float64), side='right')
+    posstart = np.searchsorted(keys, base+np.float32(1.-thresholds).astype(np.float64), side='left')
+    counts = dict(
+        items=np.repeat(end-start, len(thresholds), axis=1),
+        neg=negend-start,
+        pos=end-posstart,
+        total=(negend-start)+(end-posstart)-np.maximum(negend-posstart, 0),
+        labeled_neg=cumlab[negend]-cumlab[start],
+        correct_neg=cumneg[negend]-cumneg[start],
+        labeled_pos=cumlab[end]-cumlab[posstart],
+        correct_pos=cumpos[end]-cumpos[posstart],
+    )
+    # add totals over datasets
+    if len(names) > 1:
+        names = list(names)+['all']
+        counts = dict((k, np.vstack((v, v.sum(axis=0)))) for k, v in counts.iteritems())
+    ratio = lambda a, b: float(a)/b if b else None
+    rows = []
+    for t, threshold in enumerate(thresholds):
+        for d, name in enumerate(names):
+            c = dict((k, int(v[d,t])) for k, v in counts.iteritems())
+            rows.append(dict(source=source, threshold=float(threshold), dataset=name,
+                             items=c['items'], neg=c['neg'], pos=c['pos'], total=c['total'],
+                             fraction=ratio(c['total'], c['items']),
+                             precision_neg=ratio(c['correct_neg'], c['labeled_neg']),
+                             precision_pos=ratio(c['correct_pos'], c['labeled_pos']),
+                             precision=ratio(c['correct_neg']+c['correct_pos'], c['labeled_neg']+c['labeled_pos']),
+                             labeled=c['labeled_neg']+c['labeled_pos']))
+    return rows
+
+
+report_columns = ('source','threshold','dataset','items','neg','pos','total','fraction','labeled','precision_neg','precision_pos','precision')
+
+if args.sweep:
+    thresholds = parse_thresholds(args.sweep)
+    pred, _ = predtable.read_predictions(fnin, header=args.filelist_header)
+    if args.out_prefix_filelists:
+        out_prefixes = predtable.read_filelists(args.out_prefix_filelists.split(','), header=True)
+        rows, found = out_prefixes.lookup(pred.ids)
+        pred.dataset = np.where(found, out_prefixes.dataset[rows], len(out_prefixes.datasets))
+        pred.datasets = list(out_prefixes.datasets)+(['unknown'] if not found.all() else [])
+    if args.gt and not args.val_predictions:
+        # ground truth for the predicted items
+        gt = predtable.read_filelists(args.gt.split(','), header=True, suffix=args.gt_suffix)
+        rows, found = gt.lookup(pred.ids)
+        pred.label = np.where(found, gt.label[rows], np.nan).astype(np.float32)
+    report = sweep(pred, thresholds, 'predictions')
+    if args.val_predictions:
+        # validation items are given as <dataset>/<item>, as for evaluate_auc.py
+        val, _ = predtable.read_predictions(args.val_predictions, header=True)
+        if args.gt:
+            gt = predtable.read_filelists(args.gt.split(','), header=True, suffix=args.gt_suffix, subpath=True)
+            val, missing = val.join(gt)
+            if len(missing):
+                print >>sys.stderr, "%i validation items missing in predictions or ground truth"%len(missing)
+        report.extend(sweep(val, thresholds, 'validation'))
+
+    fout = open(args.report, 'w') if args.report else sys.stdout
+    if args.report and args.report.endswith('.json'):
+        json.dump(report, fout, sort_keys=True)
+    else:
+        print >>fout, ','.join(report_columns)
+        for row in report:
+            print >>fout, ','.join('' if row[k] is None else ('%.6g'%row[k] if isinstance(row[k], float) else str(row[k])) for k in report_columns)
+    if args.report:
+        fout.close()
+else:
+    # dataset ids of all items, keyed by item id
+    out_prefixes = predtable.read_filelists(args.out_prefix_filelists.split(','), header=True)
+
+    pred, hdr = predtable.read_predictions(fnin, header=args.filelist_header)
+    ok = (pred.pred <= np.float32(thr)) | (pred.pred >= np.float32(1.-thr))
+    sel = pred.take(ok)
+    rows, found = out_prefixes.lookup(sel.ids)
+    if not found.all():
+        raise KeyError(sel.ids[~found][0])
+    ids = zip(sel.ids, out_prefixes.take(rows).dataset_names(), sel.pred)
+
+    random.shuffle(ids)
+
+    for fold in range(folds):
+        fn = fnout%(dict(fold=fold+1))
+        with open(fn, 'w') as fout:
+            if args.out_header and hdr is not None:
+                fout.write(hdr.split(',')[0,2:])
+            for id, datasetid, rt in ids[fold::folds]:
+                print >>fout, "%s/%s%s,%s,%.6f" % (datasetid, id, args.out_suffix, datasetid, rt)
@@ -3,8 +3,10 @@ import numpy as np
 import h5py
 import os
 import sys
-from collections import defaultdict
-from itertools import izip
+import timeit
+from itertools import izip, imap
+
+import predtable
 
 import argparse
 parser = argparse.ArgumentParser()
@@ -21,36 +23,148 @@ parser.add_argument("--out-prefix", type=str, default='', help="out item prefix
 parser.add_argument("--out-suffix", type=str, default='', help="out item suffix (default='%(default)s')")
 parser.add_argument("--out-header", action='store_true', help="write eventual filelist header")
 parser.add_argument("--skip-missing", action='store_true', help="Skip files with missing predictions")
+parser.add_argument("--jobs", type=int, default=1, help="Number of processes reading prediction files in parallel (default=%(default)s)")
+parser.add_argument("--chunk-rows", type=int, default=1000000, help="Number of rows read from prediction files at once (default=%(default)s)")
 args = parser.parse_args()
     
-facc = np.__dict__[args.acc]
-facc_id = np.__dict__[args.acc_id]
+def read_ids(f5, start, stop):
+    """Reads a range of item ids from a prediction file"""
+    ids = f5['ids']
+    if isinstance(ids, h5py.Group):
+        ids = ids['id'][start:stop]
+    else:
+        ids = ids[start:stop]['id'] # compound dataset
+    return np.asarray(ids, dtype=str)
 
-res = defaultdict(list) # total results
-for fn in args.filenames:
-    resf = defaultdict(list) # per file
+
+def group_reduce(keys, values, how):
+    """
+    Reduces values per unique key with 'sum', 'mean', 'median', 'min' or 'max'.
+    Returns the sorted unique keys, the reduced values and the count per key.
+    """
+    uniq, inv = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inv, minlength=len(uniq))
+    if not len(uniq):
+        return uniq, values[:0].astype(np.float64 if how == 'sum' else values.dtype), counts
+    if how in ('sum', 'mean'):
+        # sums are kept in double precision
+        red = np.bincount(inv, weights=values, minlength=len(uniq))
+        if how == 'mean':
+            red = (red/counts).astype(values.dtype)
+    else:
+        # sort-based segment reductions
+        order = np.lexsort((values, inv)) if how == 'median' else np.argsort(inv, kind='mergesort')
+        svalues = values[order]
+        starts = np.cumsum(counts)-counts
+        if how == 'min':
+            red = np.minimum.reduceat(svalues, starts)
+        elif how == 'max':
+            red = np.maximum.reduceat(svalues, starts)
+        elif how == 'median':
+            red = (svalues[starts+(counts-1)//2]+svalues[starts+counts//2])/2
+        else:
+            raise ValueError("Unknown reduction '%s'"%how)
+    return uniq, red, counts
+
+
+def reduce_file(fn, how, chunk_rows):
+    """
+    Reads a prediction file in chunks of rows and reduces the predictions per id.
+    For 'mean', 'min' and 'max', chunk results are merged as they come in,
+    'median' needs all rows of the file.
+    Returns sorted unique ids, reduced predictions and the count per id.
+    """
     with h5py.File(fn, 'r') as f5:
-        print >>sys.stderr, "Reading", fn
-        ids = f5['ids']['id'].value
-        results = f5['results'][:,-1] # either scalar probability or two-element softmax output
-        assert len(ids) == len(results)
-        for i, r in izip(ids, results):
-            resf[i].append(r)
-    # accumulate over file and add to total
-    for i,r in resf.iteritems():
-        if len(r) != 1:
-            print >>sys.stderr, "%s: id=%s, %i times"%(fn,i,len(r))
-        res[i].append(facc_id(r))
-
-# sort ids        
-resids = sorted(res.keys())
-# calculate bagged results for each id
-mns = np.asarray([facc(res[i], axis=0) for i in resids])
+        results = f5['results'] # either scalar probability or two-element softmax output
+        idlen = len(f5['ids']['id']) if isinstance(f5['ids'], h5py.Group) else len(f5['ids'])
+        assert idlen == len(results)
+        dtype = results.dtype
+        parts = []
+        acc = None
+        for start in xrange(0, len(results), chunk_rows):
+            ids = read_ids(f5, start, start+chunk_rows)
+            res = results[start:start+chunk_rows,-1]
+            if how == 'median':
+                parts.append((ids, res))
+                continue
+            chunk = group_reduce(ids, res, 'sum' if how == 'mean' else how)
+            if acc is not None:
+                # merge with previous chunks
+                ids = np.concatenate((acc[0], chunk[0]))
+                counts = group_reduce(ids, np.concatenate((acc[2], chunk[2])), 'sum')[1].astype(np.int64)
+                uniq, red, _ = group_reduce(ids, np.concatenate((acc[1], chunk[1])), 'sum' if how == 'mean' else how)
+                chunk = (uniq, red, counts)
+            acc = chunk
+    if how == 'median' or acc is None:
+        return group_reduce(np.concatenate([p[0] for p in parts] or [np.empty(0, dtype=str)]),
+                            np.concatenate([p[1] for p in parts] or [np.empty(0, dtype=dtype)]), how)
+    uniq, red, counts = acc
+    if how == 'mean':
+        red = (red/counts).astype(dtype)
+    return uniq, red, counts
+
+
+def bag(model_ids, model_preds, how):
+    """
+    Combines the per-id predictions of several models with 'mean' or 'median'.
+    Returns the sorted union of ids and the bagged predictions.
+    """
+    resids = np.unique(np.concatenate(model_ids))
+    preds = np.zeros((len(resids), len(model_ids)), dtype=np.result_type(*model_preds))
+    present = np.zeros(preds.shape, dtype=bool)
+    for m, (ids, p) in enumerate(izip(model_ids, model_preds)):
+        pos = np.searchsorted(resids, ids)
+        preds[pos,m] = p
+        present[pos,m] = True
+    # move available predictions to the front, in model order
+    order = np.argsort(~present, axis=1, kind='mergesort')
+    preds = preds[np.arange(len(preds))[:,np.newaxis], order]
+    counts = present.sum(axis=1)
+    facc = np.__dict__[how]
+    mns = np.empty(len(preds), dtype=preds.dtype)
+    for k in np.unique(counts):
+        rows = counts == k
+        mns[rows] = facc(preds[rows,:k], axis=1)
+    return resids, mns
+
+
+def read_model(fn):
+    """Returns the per-id reduction of a prediction file along with its read time"""
+    t0 = timeit.default_timer()
+    ids, preds, counts = reduce_file(fn, args.acc_id, args.chunk_rows)
+    return ids, preds, counts, timeit.default_timer()-t0
+
+
+t0 = timeit.default_timer()
+if args.jobs > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(min(args.jobs, len(args.filenames)))
+    reduced = pool.imap(read_model, args.filenames) # in order of files
+else:
+    reduced = imap(read_model, args.filenames)
+
+model_ids = []
+model_preds = []
+total_rows = 0
+for fn, (ids, preds, counts, t) in izip(args.filenames, reduced):
+    print >>sys.stderr, "Reading", fn
+    for i, c in izip(ids[counts != 1], counts[counts != 1]):
+        print >>sys.stderr, "%s: id=%s, %i times"%(fn,i,c)
+    print >>sys.stderr, "%s: %i rows, %i ids, read in %.2fs"%(fn, counts.sum(), len(ids), t)
+    total_rows += counts.sum()
+    model_ids.append(ids)
+    model_preds.append(preds)
+if args.jobs > 1:
+    pool.close()
+t = timeit.default_timer()-t0
+print >>sys.stderr, "Read %i rows from %i files in %.2fs (%.0f rows/s)"%(total_rows, len(args.filenames), t, total_rows/max(t, 1e-6))
+
+resids, mns = bag(model_ids, model_preds, args.acc)
 
 prefun = (lambda fn:fn) if args.keep_prefix else (lambda fn: os.path.split(fn)[-1])
 suffun = (lambda fn:fn) if args.keep_suffix else (lambda fn: os.path.splitext(fn)[0])
 
-results = dict(zip((suffun(prefun(r)) for r in resids), mns))
+results = predtable.PredTable([suffun(prefun(r)) for r in resids], pred=mns)
 
 if args.filelist:
     if args.out:
@@ -59,26 +173,22 @@ if args.filelist:
         fout = sys.stdout
     
     for whichfilelist,fn in enumerate(args.filelist.split(',')):
-        with open(fn, 'r') as flist:
-            for lni,ln in enumerate(flist):
-                if lni == 0 and args.filelist_header:
-                    if whichfilelist==0:
-                        if args.out_header:
-                            print >>fout, ln.strip().replace(',datasetid', '') # replicate header line but without datasetid
+        columns, hdr = predtable.read_columns(fn, header=args.filelist_header)
+        if hdr is not None and whichfilelist==0 and args.out_header:
+            print >>fout, hdr.strip().replace(',datasetid', '') # replicate header line but without datasetid
+        fids = [i.strip() for i in columns[0]] if columns else [] # first column only
+        rows, found = results.lookup(fids)
+        for fid, pred, ok in izip(fids, results.pred[rows], found):
+            if not ok:
+                print >>sys.stderr, "Prediction missing for %s," % fid
+                if args.skip_missing:
+                    print >>sys.stderr, "skipping."
+                    continue
                 else:
-                    fid = ln.strip().split(',')[0].strip() # first column only
-                    try:
-                        pred = results[fid]
-                    except KeyError:
-                        print >>sys.stderr, "Prediction missing for %s," % fid
-                        if args.skip_missing:
-                            print >>sys.stderr, "skipping."
-                            continue
-                        else:
-                            print >>sys.stderr, "exiting."
-                            exit(-1)
-                    if pred <= args.threshold or pred >= 1.-args.threshold:
-                        print >>fout, "%s%s%s,%.6f" % (args.out_prefix, fid, args.out_suffix, pred)
+                    print >>sys.stderr, "exiting."
+                    exit(-1)
+            if pred <= args.threshold or pred >= 1.-args.threshold:
+                print >>fout, "%s%s%s,%.6f" % (args.out_prefix, fid, args.out_suffix, pred)
 
     if args.out:
         fout.close()
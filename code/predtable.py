@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Columnar tables of item predictions and labels for the evaluation tools
+(predict.py, evaluate_auc.py, make_pseudo.py): an array of item ids, an
+array of dataset codes (indices into a list of dataset names) and float32
+columns for predictions and labels. Tables keep the order of their files;
+ids are looked up by binary search in a sorted index, where later entries
+of duplicated ids take precedence (like assigning them to a dict).
+The AUC class scores predictions against labels.
+"""
+
+import numpy as np
+import os
+
+
+def read_columns(fn, header=False):
+    """
+    Returns the lines of a CSV file split into columns, as a list of lists
+    of strings, along with the header line (or None).
+    """
+    with open(fn, 'r') as f:
+        hdr = f.next() if header else None
+        rows = [ln.strip().split(',') for ln in f if ln.strip()]
+    ncols = min(len(r) for r in rows) if rows else 0
+    return [[r[c] for r in rows] for c in xrange(ncols)], hdr
+
+
+class PredTable(object):
+    """
+    Item ids with optional dataset codes, predictions and labels
+    (see module documentation).
+    """
+
+    def __init__(self, ids, pred=None, label=None, dataset=None, datasets=()):
+        self.ids = np.asarray(ids, dtype=str)
+        self.pred = None if pred is None else np.asarray(pred, dtype=np.float32)
+        self.label = None if label is None else np.asarray(label, dtype=np.float32)
+        self.dataset = None if dataset is None else np.asarray(dataset, dtype=np.int32)
+        self.datasets = np.asarray(datasets, dtype=str)
+        self._index = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def index(self):
+        """Stable sort order of the ids, computed on first use"""
+        if self._index is None:
+            order = np.argsort(self.ids, kind='mergesort')
+            self._index = order, self.ids[order]
+        return self._index
+
+    def lookup(self, ids):
+        """
+        Returns the rows of the given ids (the last one for duplicated ids),
+        and a boolean mask of ids found in the table (rows of others are 0).
+        """
+        ids = np.asarray(ids, dtype=str)
+        order, sids = self.index
+        if not len(sids):
+            return np.zeros(ids.shape, dtype=np.intp), np.zeros(ids.shape, dtype=bool)
+        pos = np.maximum(np.searchsorted(sids, ids, side='right')-1, 0)
+        found = sids[pos] == ids
+        return np.where(found, order[pos], 0), found
+
+    def mask(self, ids):
+        """Returns a boolean mask of the rows whose id is among the given ones"""
+        return np.in1d(self.ids, ids)
+
+    def take(self, rows):
+        """Returns a table of the given rows (indices or boolean mask)"""
+        col = lambda c: None if c is None else c[rows]
+        return PredTable(self.ids[rows], col(self.pred), col(self.label), col(self.dataset), self.datasets)
+
+    def unique(self):
+        """Returns a table with one row per id (the last one), sorted by id"""
+        order, sids = self.index
+        last = np.ones(len(sids), dtype=bool)
+        last[:-1] = sids[1:] != sids[:-1]
+        return self.take(order[last])
+
+    def dataset_names(self):
+        """Returns the dataset name of each row"""
+        return self.datasets[self.dataset]
+
+    def join(self, other):
+        """
+        Returns a table of the unique ids present in both tables, sorted by id,
+        with the columns of this table completed by those of the other one,
+        and the ids present in only one of the tables.
+        """
+        a = self.unique()
+        b = other.unique()
+        _, ia, ib = np.intersect1d(a.ids, b.ids, assume_unique=True, return_indices=True)
+        joined = a.take(ia)
+        for name in ('pred', 'label', 'dataset'):
+            if getattr(joined, name) is None and getattr(b, name) is not None:
+                setattr(joined, name, getattr(b, name)[ib])
+        if joined.dataset is not None and a.dataset is None:
+            joined.datasets = b.datasets
+        return joined, np.setxor1d(a.ids, b.ids, assume_unique=True)
+
+
+class AUC(object):
+    """
+    Rank-based (Mann-Whitney) ROC AUC for a fixed set of labels and scores.
+    Scores are sorted once; tied scores count half, as in sklearn's roc_auc_score.
+    The AUC can be computed for weighted items, which is used for bootstrapping.
+    """
+
+    def __init__(self, labels, scores):
+        scores = np.asarray(scores, dtype=np.float64)
+        self.order = np.argsort(scores, kind='mergesort')
+        scores = scores[self.order]
+        self.positive = (np.asarray(labels)[self.order] > 0.5).astype(np.float64)
+        # first item of each group of tied scores
+        self.starts = np.flatnonzero(np.r_[True, scores[1:] != scores[:-1]])
+
+    def __len__(self):
+        return len(self.positive)
+
+    def __call__(self, weights=None):
+        """
+        Returns the AUC, or an AUC per row of weights (item counts in order of
+        the given items), NaN where positives or negatives are missing.
+        """
+        if weights is None:
+            weights = np.ones(len(self))
+        else:
+            weights = weights[...,self.order]
+        pos = np.add.reduceat(weights*self.positive, self.starts, axis=-1)
+        neg = np.add.reduceat(weights, self.starts, axis=-1)-pos
+        # negatives scored lower, plus half the tied ones
+        below = np.cumsum(neg, axis=-1)-.5*neg
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sum(pos*below, axis=-1)/(pos.sum(axis=-1)*neg.sum(axis=-1))
+
+    def bootstrap(self, n, rng, batch_items=1<<24):
+        """
+        Returns the AUCs of n bootstrap resamples, drawn in batches of
+        resample indices of about batch_items in total.
+        """
+        items = len(self)
+        batch = max(1, batch_items//max(items, 1))
+        aucs = []
+        for start in xrange(0, n, batch):
+            b = min(batch, n-start)
+            idx = rng.randint(0, items, size=(b, items))
+            # item counts per resample
+            idx += items*np.arange(b)[:,np.newaxis]
+            counts = np.bincount(idx.ravel(), minlength=b*items).reshape(b, items)
+            aucs.append(self(counts.astype(np.float64)))
+        return np.concatenate(aucs)
+
+
+def read_predictions(fn, header=False, suffix=''):
+    """
+    Reads a prediction file with itemid,prediction lines.
+    Returns a PredTable and the header line (or None).
+    """
+    columns, hdr = read_columns(fn, header)
+    ids, preds = columns[:2] or ([], [])
+    return PredTable([i+suffix for i in ids], pred=np.asarray(preds, dtype=np.float64)), hdr
+
+
+def read_filelists(fns, header=False, suffix='', subpath=False):
+    """
+    Reads label files with itemid,datasetid,label lines into a PredTable.
+    If subpath is true, ids are prefixed by the file name without extension.
+    """
+    ids = []
+    datasetids = []
+    labels = []
+    for fn in fns:
+        columns, _ = read_columns(fn, header)
+        i, d, l = columns[:3] or ([], [], [])
+        if subpath:
+            sub = os.path.splitext(os.path.split(fn)[-1])[0]
+            i = [os.path.join(sub, k) for k in i]
+        ids.extend(k+suffix for k in i)
+        datasetids.extend(d)
+        labels.extend(l)
+    datasets, codes = np.unique(np.asarray(datasetids, dtype=str), return_inverse=True)
+    return PredTable(ids, label=np.asarray(labels, dtype=np.float64), dataset=codes, datasets=datasets)
+
+
+def read_ids(fn, header=False, suffix=''):
+    """Returns the item ids (first column) of a file list"""
+    columns, _ = read_columns(fn, header)
+    return np.asarray([i+suffix for i in columns[0]] if columns else [], dtype=str)
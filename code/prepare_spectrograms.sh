@@ -9,19 +9,23 @@ FFTLEN=${5:-1024}
 FMIN=${6:-50}
 FMAX=${7:-11000}
 BANDS=${8:-80}
+JOBS=${9:-`nproc 2> /dev/null || echo 1`}
+STORE=${10:-0}
+DTYPE=${11:-float32}
+RESAMPLE=${12:-ffmpeg}
 
-for f in ${AUDIO}/*/*.wav
-do
-    b="${f##*/}"
-    p="${f%/*}"  # full path
-    sp="${p##*/}"  # subpath
-    mkdir $SPECT/$sp 2> /dev/null
-    o="$SPECT/$sp/${b}.h5"
-    if [ ! -f "$o" ]; then
-        echo "Making ${o}"
-        if ! $here/extract_melspect.py --channels=mix-after -r ${SR} -f ${FPS} -l ${FFTLEN} -t mel -m ${FMIN} -M ${FMAX} -b ${BANDS} -s log --featname "features" --include-times --times-mode=borders "$f" "$o"; then
-            echo "Failed making ${o} - exiting"
-            exit $?
-        fi
-    fi
-done
+if [ "$STORE" == "1" ]; then
+    # one consolidated store per dataset instead of one file per clip
+    storeargs="--store"
+else
+    storeargs=""
+fi
+
+# all files are processed in one run of extract_melspect.py; outputs are written atomically, and existing
+# outputs are skipped unless computed with other parameters or from a since modified audio file
+echo "Making spectrograms for ${AUDIO}/*/*.wav in ${SPECT} with ${JOBS} processes"
+if ! $here/extract_melspect.py --channels=mix-after -r ${SR} -f ${FPS} -l ${FFTLEN} -t mel -m ${FMIN} -M ${FMAX} -b ${BANDS} -s log --featname "features" --include-times --times-mode=borders \
+        --input-glob "${AUDIO}/*/*.wav" --output-dir "${SPECT}" --output-suffix ".h5" --jobs ${JOBS} --dtype ${DTYPE} --resample ${RESAMPLE} ${storeargs}; then
+    echo "Failed making some spectrograms - exiting"
+    exit 1
+fi
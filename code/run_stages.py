@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""
+Runs the stages of run.sh as a graph of per-model jobs, with independent
+jobs (such as the training of bagged models) running in parallel:
+
+  stage1_prepare -> stage1_train_model i -> stage1_validate_model i -> stage1_validate_bag
+                                         -> stage1_predict_model i  -> stage1_predict_bag
+  stage1_predict_bag -> stage2_prepare -> stage2_train_model i h -> stage2_validate_model i h -> stage2_validate_bag
+                                                                 -> stage2_predict_model i h  -> stage2_predict_bag
+
+Jobs whose output file already exists are skipped, as in run.sh. Each job
+writes its output to a log file <logdir>/<job>.log; timings are reported
+on stderr and collected in <logdir>/timing.csv.
+
+Usage: run_stages.py [--jobs N] [--stage2] [-- <extra arguments for training and evaluation>]
+"""
+
+import os
+import sys
+import subprocess
+import time
+
+import argparse
+parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+parser.add_argument('--jobs', type=int, default=1, help='number of jobs run in parallel (default: %(default)s)')
+parser.add_argument('--stage2', action='store_true', help='include the second stage (pseudo-labeling)')
+parser.add_argument('--skip-prepare', action='store_true', help='do not run stage1_prepare (file lists and spectrograms)')
+parser.add_argument('--logdir', type=str, help='directory for job logs (default: <WORKPATH>/logs)')
+parser.add_argument('--dry-run', action='store_true', help='only print the jobs in order')
+parser.add_argument('cmdargs', nargs=argparse.REMAINDER, help='extra arguments for training and evaluation (after --)')
+args = parser.parse_args()
+if args.jobs < 1:
+    parser.error('--jobs must be at least 1')
+
+runsh = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'run.sh')
+cmdargs = args.cmdargs[1:] if args.cmdargs[:1] == ['--'] else args.cmdargs
+
+
+def stage_config():
+    """Returns the settings of run.sh needed to build the job graph"""
+    out = subprocess.check_output(['bash', runsh, 'stage_config'])
+    return dict(ln.split('=', 1) for ln in out.splitlines() if '=' in ln)
+
+
+class Job(object):
+    """A call of a run.sh function, to be run after its dependencies"""
+
+    def __init__(self, name, command, deps=(), output=None, optional=False):
+        """
+        @param name: job name, used for the log file
+        @param command: run.sh function and arguments
+        @param deps: jobs that have to be finished before
+        @param output: file whose existence means that the job is done
+        @param optional: if true, dependent jobs also run when this one fails
+        """
+        self.name = name
+        self.command = command
+        self.deps = list(deps)
+        self.output = output
+        self.optional = optional
+
+
+def build_jobs(config):
+    """Returns the list of jobs, in an order compatible with their dependencies"""
+    workpath = config['WORKPATH']
+    models = range(1, int(config['model_count'])+1)
+    folds = range(1, int(config.get('pseudo_folds') or 0)+1)
+    with_test = config['TEST'].strip() != ''
+
+    jobs = []
+    def add(*a, **kw):
+        jobs.append(Job(*a, **kw))
+        return jobs[-1]
+
+    prepare = [] if args.skip_prepare else [add('stage1_prepare', ['stage1_prepare'])]
+    trains = [add('stage1_train_model_%i'%i, ['stage1_train_model', str(i)]+cmdargs, prepare,
+                  output=os.path.join(workpath, 'model_first_%i.h5'%i)) for i in models]
+    validations = [add('stage1_validate_model_%i'%i, ['stage1_validate_model', str(i)]+cmdargs, [t],
+                       output=os.path.join(workpath, 'model_first_%i.validation.h5'%i), optional=True)
+                   for i, t in zip(models, trains)]
+    add('stage1_validate_bag', ['stage1_validate_bag'], validations)
+    if not with_test:
+        return jobs
+    predictions = [add('stage1_predict_model_%i'%i, ['stage1_predict_model', str(i)]+cmdargs, [t],
+                       output=os.path.join(workpath, 'model_first_%i.prediction.h5'%i))
+                   for i, t in zip(models, trains)]
+    predict_bag = add('stage1_predict_bag', ['stage1_predict_bag'], predictions)
+    if not args.stage2:
+        return jobs
+
+    prepare2 = add('stage2_prepare', ['stage2_prepare'], [predict_bag])
+    validations = []
+    predictions = []
+    for i in models:
+        for h in folds:
+            model = os.path.join(workpath, 'model_second_%i_%i'%(i, h))
+            t = add('stage2_train_model_%i_%i'%(i, h), ['stage2_train_model', str(i), str(h)]+cmdargs, [prepare2],
+                    output=model+'.h5')
+            validations.append(add('stage2_validate_model_%i_%i'%(i, h), ['stage2_validate_model', str(i), str(h)]+cmdargs, [t],
+                                   output=model+'.validation.h5', optional=True))
+            predictions.append(add('stage2_predict_model_%i_%i'%(i, h), ['stage2_predict_model', str(i), str(h)]+cmdargs, [t],
+                                   output=model+'.prediction.h5'))
+    add('stage2_validate_bag', ['stage2_validate_bag'], validations)
+    add('stage2_predict_bag', ['stage2_predict_bag'], predictions)
+    return jobs
+
+
+def run(jobs, logdir):
+    """
+    Runs the jobs with at most args.jobs in parallel.
+    Returns the names of failed jobs and of jobs not run because of them.
+    """
+    done = set() # finished, or allowed to have failed
+    failed = []
+    pending = list(jobs)
+    running = {} # job name => (job, process, start time, log file)
+    timing = []
+    while pending or running:
+        # start jobs whose dependencies are done
+        for job in list(pending):
+            if any(d.name in failed for d in job.deps if not d.optional):
+                pending.remove(job)
+                failed.append(job.name)
+                if job.optional:
+                    done.add(job.name)
+                print >>sys.stderr, "Not running %s (dependency failed)"%job.name
+            elif len(running) < args.jobs and all(d.name in done for d in job.deps):
+                pending.remove(job)
+                if job.output and os.path.exists(job.output):
+                    print >>sys.stderr, "Using existing %s"%job.output
+                    done.add(job.name)
+                    continue
+                log = open(os.path.join(logdir, job.name+'.log'), 'w')
+                print >>sys.stderr, "Starting %s"%job.name
+                proc = subprocess.Popen(['bash', runsh]+job.command, stdout=log, stderr=subprocess.STDOUT)
+                running[job.name] = (job, proc, time.time(), log)
+        if pending and not running:
+            # nothing runs that could finish the dependencies of pending jobs
+            raise RuntimeError("No job can be started: %s"%', '.join(job.name for job in pending))
+        # collect finished jobs
+        time.sleep(0.5 if running else 0)
+        for name, (job, proc, t0, log) in running.items():
+            if proc.poll() is not None:
+                del running[name]
+                log.close()
+                t = time.time()-t0
+                timing.append((name, proc.returncode, t))
+                if proc.returncode == 0 or job.optional:
+                    done.add(name)
+                if proc.returncode != 0:
+                    failed.append(name)
+                print >>sys.stderr, "%s %s after %.1fs (log in %s)"%(name, 'failed' if proc.returncode else 'finished', t, log.name)
+
+    with open(os.path.join(logdir, 'timing.csv'), 'a') as f:
+        for name, rc, t in timing:
+            print >>f, "%s,%i,%.1f"%(name, rc, t)
+    return failed
+
+
+config = stage_config()
+jobs = build_jobs(config)
+if args.dry_run:
+    for job in jobs:
+        print "%s: run.sh %s (after %s)"%(job.name, ' '.join(job.command), ', '.join(d.name for d in job.deps) or '-')
+    sys.exit(0)
+
+logdir = args.logdir or os.path.join(config['WORKPATH'], 'logs')
+if not os.path.isdir(logdir):
+    os.makedirs(logdir)
+t0 = time.time()
+failed = run(jobs, logdir)
+print >>sys.stderr, "Done after %.1fs, %i of %i jobs failed or not run%s"%(time.time()-t0, len(failed), len(jobs), (': '+', '.join(failed)) if failed else '')
+sys.exit(1 if failed else 0)
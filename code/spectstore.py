@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Consolidated store for the spectrograms of many files: all feature matrices
+of a dataset are concatenated along time in a single HDF5 file, with an index
+holding the offset and length of each file id.
+
+Layout of a store file:
+  /<name>          one dataset per feature name (such as 'features'),
+                   shape (total frames, ...)
+  /index/id        file ids (such as 'xyz.wav')
+  /index/offset    first frame of each file
+  /index/length    number of frames of each file
+  /index/source_size, /index/source_mtime
+                   size and modification time of the source (audio) file
+                   of each file id, if known (see extract_melspect.py)
+  /index/<name>    further per-file scalars, such as the scale and offset of
+                   quantized features ('features_scale', 'features_offset')
+  attributes       'framerate' and the extraction options
+
+Usage:
+  with SpectStore('spect/ff1010bird.store.h5', 'a') as store:
+      store.append('xyz.wav', [('features', spect)])
+  data = get_store('spect/ff1010bird.store.h5').load('xyz.wav')
+
+Features can be stored as float16 or as uint8 with a per-file scale and
+offset (see quantize()); dequantize() restores float32 matrices from the
+loaded data of a file.
+
+Stores are written with chunked datasets; for memory-mapped reading, copy
+them to a contiguous layout with
+  spectstore.py spect/ff1010bird.store.h5 spect/ff1010bird.contiguous.store.h5
+"""
+
+import numpy as np
+import h5py
+import threading
+
+STORE_SUFFIX = '.store.h5'
+
+
+QUANTIZED_DTYPES = ('float32', 'float16', 'uint8')
+
+
+def quantize(spect, dtype='float32'):
+    """
+    Converts a feature matrix to the storage type dtype (see QUANTIZED_DTYPES;
+    float32 keeps the matrix as it is, including complex spectra). Returns
+    the converted matrix and the (scale, offset) pair that restores it, or
+    None if no scaling is needed. For uint8, the finite range of spect is
+    mapped to 0..255; non-finite values (such as log(0)) map to the minimum.
+    Complex spectra can only be stored as float32.
+    """
+    if dtype == 'float32':
+        return spect, None
+    elif np.iscomplexobj(spect):
+        raise ValueError("Complex features can only be stored as float32, not '%s'"%dtype)
+    elif dtype == 'float16':
+        return spect.astype(np.float16), None
+    elif dtype != 'uint8':
+        raise ValueError("Unsupported feature storage type '%s'"%dtype)
+    finite = np.isfinite(spect)
+    if finite.any():
+        low = float(spect[finite].min())
+        high = float(spect[finite].max())
+    else:
+        low = high = 0.
+    scale = (high-low)/255. or 1.
+    q = np.where(finite, spect, low)
+    q -= low
+    q *= 1./scale
+    np.rint(q, out=q)
+    return np.clip(q, 0, 255).astype(np.uint8), (np.float32(scale), np.float32(low))
+
+
+def dequantize(data, name='features'):
+    """
+    Returns the feature matrix name of the loaded data of a file (a dict)
+    as float32, applying the '<name>_scale' and '<name>_offset' entries
+    written for quantized features.
+    """
+    spect = data[name]
+    if name+'_scale' in data:
+        scale = np.float32(np.asarray(data[name+'_scale']))
+        offset = np.float32(np.asarray(data[name+'_offset']))
+        return np.asarray(spect, dtype=np.float32)*scale+offset
+    return np.asarray(spect, dtype=np.float32)
+
+
+def quantize_data(data, dtype='float32'):
+    """
+    Quantizes (name, matrix) pairs of feature data (see quantize()), adding
+    ('<name>_scale', scale) and ('<name>_offset', offset) scalars for uint8.
+    """
+    result = []
+    for name, v in data:
+        v, scaling = quantize(np.asarray(v), dtype)
+        result.append((name, v))
+        if scaling is not None:
+            result += [(name+'_scale', scaling[0]), (name+'_offset', scaling[1])]
+    return result
+
+
+def is_store(path):
+    """Returns whether path names a spectrogram store (by its suffix)."""
+    return path.endswith(STORE_SUFFIX)
+
+
+class SpectStore(object):
+    """
+    A consolidated spectrogram store (see module documentation).
+    """
+
+    INDEX_FIELDS = ('id', 'offset', 'length', 'source_size', 'source_mtime')
+
+    def __init__(self, path, mode='r', chunk_frames=1024, mmap=False, compression=None, compression_opts=None):
+        """
+        Opens or creates a spectrogram store.
+        @param path: store file name
+        @param mode: h5py file mode, 'r' for reading, 'a' for appending
+        @param chunk_frames: HDF5 chunk length for newly created feature
+            datasets
+        @param mmap: If true, read returns np.memmap views for feature
+            datasets stored contiguously (see make_contiguous)
+        @param compression: HDF5 compression filter ('gzip', 'lzf') for
+            newly created feature datasets, with compression_opts
+        """
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.f5 = h5py.File(path, mode)
+        self.mmaps = {}
+        if mmap and mode == 'r':
+            for name in self.f5:
+                if name != 'index':
+                    ds = self.f5[name]
+                    # only contiguous, uncompressed datasets have a file offset
+                    offset = ds.id.get_offset()
+                    if ds.chunks is None and offset is not None:
+                        self.mmaps[name] = np.memmap(path, mode='r', dtype=ds.dtype, shape=ds.shape, offset=offset)
+        if 'index' in self.f5:
+            index = self.f5['index']
+            ids = index['id'][:]
+            offsets = index['offset'][:]
+            lengths = index['length'][:]
+            if 'source_size' in index:
+                self.sources = dict((i, (int(n), float(t))) for i, n, t in
+                                    zip(ids, index['source_size'][:], index['source_mtime'][:]) if n >= 0)
+            else:
+                self.sources = {}
+            # per-file scalars
+            self.scalars = dict((k, dict(zip(ids, index[k][:]))) for k in index if k not in self.INDEX_FIELDS)
+        else:
+            ids = offsets = lengths = ()
+            self.sources = {}
+            self.scalars = {}
+        self.index = dict((i, (o, n)) for i, o, n in zip(ids, offsets, lengths))
+        self.frames = int(offsets[-1]+lengths[-1]) if len(ids) else 0
+        self.names = [k for k in self.f5 if k != 'index']
+
+    def close(self):
+        self.f5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, fileid):
+        return fileid in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    @property
+    def attrs(self):
+        return self.f5.attrs
+
+    @property
+    def framerate(self):
+        return float(self.f5.attrs['framerate'])
+
+    def source(self, fileid):
+        """Returns the (size, mtime) of the source file of the given file id, or None."""
+        return self.sources.get(fileid)
+
+    def append(self, fileid, data, source=None):
+        """
+        Appends the feature matrices of a file to the store.
+        @param fileid: file id, must not be present in the store yet
+        @param data: (name, matrix) pairs, all matrices with the same length,
+            and (name, scalar) pairs stored in the index
+        @param source: (size, mtime) of the source file, if known
+        """
+        if fileid in self.index:
+            raise ValueError("File id '%s' already present in store %s"%(fileid, self.path))
+        data = list(data)
+        scalars = [(name, v) for name, v in data if np.ndim(v) == 0]
+        data = [(name, v) for name, v in data if np.ndim(v) > 0]
+        if self.index and set(name for name, _ in scalars) != set(self.scalars):
+            raise ValueError("Scalars for '%s' differ from those in store %s"%(fileid, self.path))
+        length = len(data[0][1])
+        if any(len(v) != length for _, v in data):
+            raise ValueError("Feature matrices for '%s' differ in length"%fileid)
+        if 'index' not in self.f5:
+            index = self.f5.create_group('index')
+            index.create_dataset('id', shape=(0,), maxshape=(None,), dtype=h5py.special_dtype(vlen=str))
+            index.create_dataset('offset', shape=(0,), maxshape=(None,), dtype=np.int64)
+            index.create_dataset('length', shape=(0,), maxshape=(None,), dtype=np.int64)
+            index.create_dataset('source_size', shape=(0,), maxshape=(None,), dtype=np.int64)
+            index.create_dataset('source_mtime', shape=(0,), maxshape=(None,), dtype=np.float64)
+        for name, v in data:
+            v = np.asarray(v)
+            if name not in self.f5:
+                self.f5.create_dataset(name, shape=(self.frames,)+v.shape[1:], maxshape=(None,)+v.shape[1:],
+                                       chunks=(self.chunk_frames,)+v.shape[1:], dtype=v.dtype,
+                                       compression=self.compression, compression_opts=self.compression_opts)
+                self.names.append(name)
+            ds = self.f5[name]
+            ds.resize(self.frames+length, axis=0)
+            ds[self.frames:] = v
+        index = self.f5['index']
+        pos = len(self.index)
+        fields = [('id', fileid), ('offset', self.frames), ('length', length)]
+        if 'source_size' in index:
+            size, mtime = source if source is not None else (-1, -1.)
+            fields += [('source_size', size), ('source_mtime', mtime)]
+            if source is not None:
+                self.sources[fileid] = (size, mtime)
+        for name, v in scalars:
+            if name not in index:
+                index.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.asarray(v).dtype)
+                self.scalars[name] = {}
+            fields.append((name, v))
+            self.scalars[name][fileid] = v
+        for k, v in fields:
+            index[k].resize(pos+1, axis=0)
+            index[k][pos] = v
+        self.index[fileid] = (self.frames, length)
+        self.frames += length
+
+    def read(self, fileid, name='features'):
+        """Returns the feature matrix (or scalar) of the given file id."""
+        if name in self.scalars:
+            return self.scalars[name][fileid]
+        offset, length = self.index[fileid]
+        try:
+            return self.mmaps[name][offset:offset+length]
+        except KeyError:
+            return self.f5[name][offset:offset+length]
+
+    def load(self, fileid):
+        """
+        Returns all feature matrices of the given file id in a dict, along
+        with a vector 'times' of frame borders (as extract_melspect.py
+        writes them with --times-mode=borders).
+        """
+        data = dict((name, self.read(fileid, name)) for name in self.names+self.scalars.keys())
+        length = self.index[fileid][1]
+        data['times'] = np.arange(length+1, dtype=np.float32)*(1./self.framerate)
+        return data
+
+
+def make_contiguous(src, dst):
+    """
+    Copies the store src to dst, with contiguous, uncompressed feature
+    datasets that can be memory-mapped (see SpectStore).
+    """
+    with h5py.File(src, 'r') as fsrc, h5py.File(dst, 'w') as fdst:
+        fsrc.copy('index', fdst)
+        for k, v in fsrc.attrs.items():
+            fdst.attrs[k] = v
+        for name in fsrc:
+            if name != 'index':
+                ds = fsrc[name]
+                out = fdst.create_dataset(name, shape=ds.shape, dtype=ds.dtype)
+                step = 65536
+                for pos in xrange(0, len(ds), step):
+                    out[pos:pos+step] = ds[pos:pos+step]
+
+
+# stores opened for reading (see get_store)
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(path, mmap=False):
+    """Returns a SpectStore opened for reading, reusing previously opened ones."""
+    with _stores_lock:
+        try:
+            return _stores[path, mmap]
+        except KeyError:
+            store = _stores[path, mmap] = SpectStore(path, 'r', mmap=mmap)
+            return store
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Copy spectrogram stores to a contiguous layout for memory-mapped reading')
+    parser.add_argument('src', type=str, help='input store file')
+    parser.add_argument('dst', type=str, help='output store file')
+    args = parser.parse_args()
+    make_contiguous(args.src, args.dst)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""
+Compares spectrograms stored in a compact format (extract_melspect.py
+--dtype float16/uint8, --compression) with a float32 reference: reports
+the maximum and mean absolute error of the dequantized features and the
+storage sizes, and optionally the AUC difference of predictions made from
+both versions (prediction files of predict.py).
+
+Inputs are spectrogram stores (<dataset>.store.h5) or directories with
+one spectrogram file per clip (<dir>/<dataset>/<clip>.h5), as for
+make_prepstats.py. Entries are matched by file id (<dataset>/<clip>).
+"""
+
+import numpy as np
+import h5py
+import glob
+import os
+import sys
+
+import spectstore
+import predtable
+
+import argparse
+parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+parser.add_argument("reference", type=str, help="reference spectrograms (store or directory)")
+parser.add_argument("compact", type=str, help="compact spectrograms (store or directory)")
+parser.add_argument("--feature", type=str, default='features', help="feature name (default='%(default)s')")
+parser.add_argument("--predictions", nargs=2, type=str, metavar=('REF', 'COMPACT'), help="prediction files made from the reference and the compact spectrograms")
+parser.add_argument("--pred-header", action='store_true', help="header line present in prediction files")
+parser.add_argument("--gt", nargs='+', type=str, default=[], help="ground truth file(s) for the AUC of --predictions")
+parser.add_argument("--gt-header", action='store_true', help="header line present in ground truth file(s)")
+parser.add_argument("--gt-suffix", type=str, default='', help="suffix for items in ground-truth file(s)")
+args = parser.parse_args()
+
+
+def entries(inp):
+    """Returns a dict of file id => (path, store key or None) and the total size in bytes"""
+    if spectstore.is_store(inp):
+        dataset = os.path.basename(inp)[:-len(spectstore.STORE_SUFFIX)]
+        with spectstore.SpectStore(inp) as store:
+            keys = store.keys()
+        return dict((dataset+'/'+k, (inp, k)) for k in keys), os.path.getsize(inp)
+    fns = glob.glob(os.path.join(inp, '*', '*.h5'))
+    return dict((os.path.relpath(fn, inp)[:-len('.h5')], (fn, None)) for fn in fns), sum(os.path.getsize(fn) for fn in fns)
+
+
+def read_features(path, key):
+    """Returns the dequantized features of a store entry or file"""
+    names = (args.feature, args.feature+'_scale', args.feature+'_offset')
+    if key is not None:
+        store = spectstore.get_store(path)
+        data = dict((k, store.read(key, k)) for k in names if k in store.names or k in store.scalars)
+    else:
+        with h5py.File(path, 'r') as f5:
+            data = dict((k, f5[k][()]) for k in names if k in f5)
+    return spectstore.dequantize(data, args.feature)
+
+
+ref, ref_size = entries(args.reference)
+compact, compact_size = entries(args.compact)
+common = sorted(set(ref) & set(compact))
+if len(common) < len(ref) or len(common) < len(compact):
+    print >>sys.stderr, "%i file ids present in only one of the inputs"%(len(set(ref) ^ set(compact)))
+
+max_err = 0.
+worst = None
+abs_sum = 0.
+values = 0
+for fileid in common:
+    a = read_features(*ref[fileid])
+    b = read_features(*compact[fileid])
+    if a.shape != b.shape:
+        raise ValueError("Shapes of '%s' differ: %s vs. %s"%(fileid, a.shape, b.shape))
+    # errors of finite reference values (uint8 stores non-finite ones as the minimum)
+    finite = np.isfinite(a)
+    err = np.abs(a[finite]-b[finite])
+    if len(err) and err.max() > max_err:
+        max_err = float(err.max())
+        worst = fileid
+    abs_sum += err.sum(dtype=np.float64)
+    values += err.size
+
+print "files: %i"%len(common)
+print "max abs error: %.6g%s"%(max_err, (" (%s)"%worst) if worst else "")
+print "mean abs error: %.6g"%(abs_sum/max(values, 1))
+print "size: %.1f MB vs. %.1f MB (%.2fx smaller)"%(ref_size/2.**20, compact_size/2.**20, ref_size/max(float(compact_size), 1.))
+
+if args.predictions:
+    gt = predtable.read_filelists(args.gt, header=args.gt_header, suffix=args.gt_suffix, subpath=True)
+    aucs = []
+    for fn in args.predictions:
+        pred, _ = predtable.read_predictions(fn, header=args.pred_header)
+        both, _ = pred.join(gt)
+        aucs.append(predtable.AUC(both.label, both.pred)())
+    print "AUC: %.6f vs. %.6f (difference %+.6f)"%(aucs[0], aucs[1], aucs[1]-aucs[0])
@@ -18,6 +18,17 @@ here="${0%/*}"
 LISTPATH="$WORKPATH/filelists"
 SPECTPATH="$WORKPATH/spect"
 
+# spectrogram data for load_data.py: one file per clip, one store per dataset, or computed from the audio files
+spectinput="type=spect"
+if [ "${SPEC_ONTHEFLY}" == "1" ]; then
+    spectdata="${AUDIOPATH}/%(id)s"
+    spectinput="type=melspect,spect_sr=${SPEC_SR},spect_fps=${SPEC_FPS},spect_fftlen=${SPEC_FFTLEN},spect_fmin=${SPEC_FMIN},spect_fmax=${SPEC_FMAX},spect_bands=${SPEC_BANDS},spect_resample=${SPEC_RESAMPLE}"
+elif [ "${SPEC_STORE}" == "1" ]; then
+    spectdata="${SPECTPATH}/%(dataset)s.store.h5"
+else
+    spectdata="${SPECTPATH}/%(id)s.h5"
+fi
+
 
 # locations of prediction files
 first_predictions="$WORKPATH/prediction_first.csv"
@@ -73,9 +84,9 @@ function train_model {
     --var filelist:sep=',' \
     --var filelist:column=0 \
     --process "filelistshuffle:shuffle(seed=$seed,memory=25000)" \
-    --process "input:${here}/code/load_data.py(type=spect,downmix=0,cycle=0,denoise=1,width=${net_width},seed=$seed)" \
+    --process "input:${here}/code/load_data.py(${spectinput},downmix=0,cycle=0,denoise=1,width=${net_width},seed=$seed)" \
     --var input:labels="${LABELPATH}"/'*.csv',"${extralabels}" \
-    --var input:data="${SPECTPATH}/%(id)s.h5" \
+    --var input:data="${spectdata}" \
     --var input:data_vars=1k \
     --process collect:collect \
     --var "collect:source=0..1"  \
@@ -104,7 +115,7 @@ function evaluate_model {
     "$here/code/simplenn_main.py" \
     --mode=evaluate \
     --var input:labels="${LABELPATH}"/'*.csv' \
-    --var input:data="${SPECTPATH}/%(id)s.h5" \
+    --var input:data="${spectdata}" \
     --var input:targets_needed=0 \
     --var filelist:path="$LISTPATH" \
     --var filelist:lists="$filelists" \
@@ -130,11 +141,15 @@ function stage1_prepare {
         "$here/code/create_filelists.py" "$LABELPATH" ${TEST}  --mode "test"  --out "$LISTPATH/%(fold)s"         || return $?
     fi
 
-    echo_status "Computing spectrograms."
-    mkdir $SPECTPATH 2> /dev/null
-    "$here/code/prepare_spectrograms.sh" "${AUDIOPATH}" "${SPECTPATH}" ${SPEC_SR} ${SPEC_FPS} ${SPEC_FFTLEN} ${SPEC_FMIN} ${SPEC_FMAX} ${SPEC_BANDS}
+    if [ "${SPEC_ONTHEFLY}" == "1" ]; then
+        echo_status "NOT computing spectrograms since they are computed while loading."
+    else
+        echo_status "Computing spectrograms."
+        mkdir $SPECTPATH 2> /dev/null
+        "$here/code/prepare_spectrograms.sh" "${AUDIOPATH}" "${SPECTPATH}" ${SPEC_SR} ${SPEC_FPS} ${SPEC_FFTLEN} ${SPEC_FMIN} ${SPEC_FMAX} ${SPEC_BANDS} "" ${SPEC_STORE} ${SPEC_DTYPE} ${SPEC_RESAMPLE}
 
-    echo_status "Done computing spectrograms."
+        echo_status "Done computing spectrograms."
+    fi
 
     email_status "Done with stage1 preparations" "Computed filelists and spectrograms."
 }
@@ -156,17 +171,23 @@ function stage1_train {
     fi
 
     for i in ${idxs}; do
-        model="$WORKPATH/model_first_${i}"
-        if [ ! -f "${model}.h5" ]; then # check for existence
-            echo_status "Training model ${model}."
-            train_model "${model}" "train_${i}" '' ${i} ${cmdargs} || return $?
-            echo_status "Done training model ${model}."
-        else
-            echo_status "Using existing model ${model}."
-        fi
+        stage1_train_model ${i} ${cmdargs} || return $?
     done
 }
 
+function stage1_train_model {
+    i="$1"
+    cmdargs="${@:2}"
+    model="$WORKPATH/model_first_${i}"
+    if [ ! -f "${model}.h5" ]; then # check for existence
+        echo_status "Training model ${model}."
+        train_model "${model}" "train_${i}" '' ${i} ${cmdargs} || return $?
+        echo_status "Done training model ${model}."
+    else
+        echo_status "Using existing model ${model}."
+    fi
+}
+
 #############################
 # first stage prediction
 #############################
@@ -181,15 +202,25 @@ function stage1_predict {
 
     cmdargs="${@:1}"
     for i in `seq ${model_count}`; do
-        model="$WORKPATH/model_first_${i}"
-        prediction="${model}.prediction"
-        if [ ! -f "${prediction}.h5" ]; then # check for existence
-            evaluate_model "${model}" "test" "${prediction}" ${cmdargs} || return $?
-        else
-            echo_status "Using existing predictions ${prediction}."
-        fi
+        stage1_predict_model ${i} ${cmdargs} || return $?
     done
 
+    stage1_predict_bag
+}
+
+function stage1_predict_model {
+    i="$1"
+    cmdargs="${@:2}"
+    model="$WORKPATH/model_first_${i}"
+    prediction="${model}.prediction"
+    if [ ! -f "${prediction}.h5" ]; then # check for existence
+        evaluate_model "${model}" "test" "${prediction}" ${cmdargs} || return $?
+    else
+        echo_status "Using existing predictions ${prediction}."
+    fi
+}
+
+function stage1_predict_bag {
     # prediction by bagging
     echo_status "Bagging first stage predictions."
     "$here/code/predict.py" "$WORKPATH"/model_first_?.prediction.h5 --filelist "$testfilelists" --filelist-header --out "$first_predictions" --out-header || return $?
@@ -206,15 +237,25 @@ function stage1_validate {
 
     cmdargs="${@:1}"
     for i in `seq ${model_count}`; do
-        model="$WORKPATH/model_first_${i}"
-        validation="${model}.validation"
-        if [ ! -f "${validation}.h5" ]; then # check for existence
-            evaluate_model "${model}" "val_${i}" "${validation}" ${cmdargs} #|| return $?
-        else
-            echo_status "Using existing validations ${validation}."
-        fi
+        stage1_validate_model ${i} ${cmdargs}
     done
 
+    stage1_validate_bag
+}
+
+function stage1_validate_model {
+    i="$1"
+    cmdargs="${@:2}"
+    model="$WORKPATH/model_first_${i}"
+    validation="${model}.validation"
+    if [ ! -f "${validation}.h5" ]; then # check for existence
+        evaluate_model "${model}" "val_${i}" "${validation}" ${cmdargs} #|| return $?
+    else
+        echo_status "Using existing validations ${validation}."
+    fi
+}
+
+function stage1_validate_bag {
     first_validations="$WORKPATH/validation_first.csv"
 
     # prediction by bagging
@@ -278,18 +319,25 @@ function stage2_train {
 
     for i in $idxs; do
         for h in $folds; do
-            model="$WORKPATH/model_second_${i}_${h}"
-            if [ ! -f "${model}.h5" ]; then # check for existence
-                echo_status "Training model ${model}."
-                train_model "${model}" "train_${i}_pseudo_${h}" "$LISTPATH/testdata.pseudo_*" ${i} ${cmdargs} || return $?
-                echo_status "Done training model ${model}."
-            else
-                echo_status "Using existing model ${model}."
-            fi
+            stage2_train_model ${i} ${h} ${cmdargs} || return $?
         done
     done
 }
 
+function stage2_train_model {
+    i="$1"
+    h="$2"
+    cmdargs="${@:3}"
+    model="$WORKPATH/model_second_${i}_${h}"
+    if [ ! -f "${model}.h5" ]; then # check for existence
+        echo_status "Training model ${model}."
+        train_model "${model}" "train_${i}_pseudo_${h}" "$LISTPATH/testdata.pseudo_*" ${i} ${cmdargs} || return $?
+        echo_status "Done training model ${model}."
+    else
+        echo_status "Using existing model ${model}."
+    fi
+}
+
 #############################################
 # second stage prediction
 # by bagging all available models
@@ -306,16 +354,27 @@ function stage2_predict {
     cmdargs="${@:1}"
     for i in `seq ${model_count}`; do
         for h in `seq ${pseudo_folds}`; do
-            model="$WORKPATH/model_second_${i}_${h}"
-            prediction="${model}.prediction"
-            if [ ! -f "${prediction}.h5" ]; then # check for existence
-                evaluate_model "${model}" test "${prediction}" ${cmdargs} || return $?
-            else
-                echo_status "Using existing predictions ${prediction}."
-            fi
+            stage2_predict_model ${i} ${h} ${cmdargs} || return $?
         done
     done
 
+    stage2_predict_bag
+}
+
+function stage2_predict_model {
+    i="$1"
+    h="$2"
+    cmdargs="${@:3}"
+    model="$WORKPATH/model_second_${i}_${h}"
+    prediction="${model}.prediction"
+    if [ ! -f "${prediction}.h5" ]; then # check for existence
+        evaluate_model "${model}" test "${prediction}" ${cmdargs} || return $?
+    else
+        echo_status "Using existing predictions ${prediction}."
+    fi
+}
+
+function stage2_predict_bag {
     echo_status "Bagging final predictions."
     "$here/code/predict.py" "$WORKPATH"/model_second*.prediction.h5 --filelist "$testfilelists" --filelist-header --out "$second_predictions" --out-header || return $?
     "$here/code/predict.py" "$WORKPATH"/model_*.prediction.h5 --filelist "$testfilelists" --filelist-header --out "$final_predictions" --out-header || return $?
@@ -333,16 +392,27 @@ function stage2_validate {
     cmdargs="${@:1}"
     for i in `seq ${model_count}`; do
         for h in `seq ${pseudo_folds}`; do
-            model="$WORKPATH/model_second_${i}_${h}"
-            validation="${model}.validation"
-            if [ ! -f "${validation}.h5" ]; then # check for existence
-                evaluate_model "${model}" "val_${i}" "${validation}" ${cmdargs} #|| return $?
-            else
-                echo_status "Using existing validations ${validation}."
-            fi
+            stage2_validate_model ${i} ${h} ${cmdargs}
         done
     done
 
+    stage2_validate_bag
+}
+
+function stage2_validate_model {
+    i="$1"
+    h="$2"
+    cmdargs="${@:3}"
+    model="$WORKPATH/model_second_${i}_${h}"
+    validation="${model}.validation"
+    if [ ! -f "${validation}.h5" ]; then # check for existence
+        evaluate_model "${model}" "val_${i}" "${validation}" ${cmdargs} #|| return $?
+    else
+        echo_status "Using existing validations ${validation}."
+    fi
+}
+
+function stage2_validate_bag {
     second_validations="$WORKPATH/validation_second.csv"
 
     # prediction by bagging
@@ -360,6 +430,15 @@ function stage2_validate {
 }
 
 
+#############################
+# settings for run_stages.py
+#############################
+function stage_config {
+    echo "WORKPATH=${WORKPATH}"
+    echo "TEST=${TEST}"
+    echo "model_count=${model_count}"
+    echo "pseudo_folds=${pseudo_folds}"
+}
 
 ###################################################################
 
@@ -370,6 +449,7 @@ if [ "$1" == 'help' -o "$1" == '-help' -o "$1" == '--help' ]; then
     echo_info ""
     echo_info "Without any arguments, the full two-stage train/predict sequence is run"
     echo_info "Subtasks can be run by specifying one of: stage1_prepare, stage1_train, stage1_predict, stage2_prepare, stage2_train, stage2_predict"
+    echo_info "Per-model subtasks (such as stage1_train_model <index>) can be run in parallel with code/run_stages.py"
 elif [ "$1" == "" -o "${1:0:1}" == '-' ]; then
     echo_info "Running full two-stage train/predict sequence:"
     cmdargs="${@:1}"